@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Generates synthetic BRAG files for benchmarking
+
+    python benchmarks/generate.py -u 10 -s 100 -t 5 --comments 0.3 --inactive 2 --styles dash,star,number > brag.md
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import argparse
+import random
+from datetime import datetime, timedelta
+
+TASK_WORDS = ["run", "marathon", "submit", "pull", "requests", "write", "blog", "post",
+              "meditate", "call", "mom", "fix", "bike", "read", "book", "ship", "release"]
+COMMENT_WORDS = ["did", "it", "in", "2:06:12", "almost", "next", "week", "blocked", "by", "review", "yay"]
+# Markers of the list styles the parser understands
+LIST_STYLES = {'dash': "-", 'star': "*", 'number': "1."}
+
+
+def generate_brag(users=5, sessions=50, tasks=5, seed=0, comments=0.0, inactive=0, styles=("dash", )):
+    """Generates the markdown of a BRAG file.
+
+    Args:
+        users: int -- number of users
+        sessions: int -- number of weekly sessions per user
+        tasks: int -- number of tasks per session
+        seed: int -- seed for the random number generator
+        comments: float -- share of tasks that have a comment, between 0 and 1
+        inactive: int -- number of users marked inactive, who left halfway
+            through the history
+        styles: tuple of str -- names of the list styles to pick from for each
+            session, see LIST_STYLES
+    Returns:
+        str
+    """
+    rng = random.Random(seed)
+    start = datetime(2016, 1, 2)
+    parts = []
+    for user in range(users):
+        is_inactive = user >= users - inactive
+        header = "# User {} <user{}@example.com>{}".format(user, user, " (inactive)" if is_inactive else "")
+        lines = [header, "", "## Goals", ""]
+        lines += ["- [{}] {}".format(rng.choice("X "), random_name(rng)) for _ in range(3)]
+        for session in range(sessions // 2 if is_inactive else sessions):
+            lines += ["", "## {:%Y-%m-%d}".format(start + timedelta(weeks=session)), ""]
+            style = rng.choice(styles) if len(styles) > 1 else styles[0]
+            for index in range(tasks):
+                marker = "{}.".format(index + 1) if style == "number" else LIST_STYLES[style]
+                line = "{} [{}] {}".format(marker, rng.choice("X O"), random_name(rng))
+                if comments and rng.random() < comments:
+                    line += " -- " + random_comment(rng)
+                lines.append(line)
+        parts.append("\n".join(lines))
+    return ("\n\n" + "-" * 45 + "\n\n").join(parts)
+
+
+def random_name(rng):
+    """Returns a random task name."""
+    return " ".join(rng.choice(TASK_WORDS) for _ in range(rng.randint(2, 6))).capitalize()
+
+
+def random_comment(rng):
+    """Returns a random comment."""
+    return " ".join(rng.choice(COMMENT_WORDS) for _ in range(rng.randint(1, 8))).capitalize()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('-u', dest='users', type=int, default=5, help='number of users')
+    parser.add_argument('-s', dest='sessions', type=int, default=50, help='number of sessions per user')
+    parser.add_argument('-t', dest='tasks', type=int, default=5, help='number of tasks per session')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the random number generator')
+    parser.add_argument('--comments', type=float, default=0.0, help='share of tasks with a comment')
+    parser.add_argument('--inactive', type=int, default=0, help='number of inactive users')
+    parser.add_argument('--styles', default="dash", help='list styles to mix, eg. "dash,star,number"')
+    args = parser.parse_args()
+    print(generate_brag(
+        users=args.users, sessions=args.sessions, tasks=args.tasks, seed=args.seed,
+        comments=args.comments, inactive=args.inactive, styles=tuple(args.styles.split(","))
+    ))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Measures peak memory of serialising brags of growing history.
+
+    python benchmarks/memory.py
+
+Brag.write streams the file and should use the same amount of memory no matter
+how many sessions there are; Brag.to_string grows with the history. The write
+is measured in the steady state, ie. after the brag has been written once, and
+with every session serialised rather than copied from the previous file.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from brag import Brag  # noqa: E402
+from generate import generate_brag  # noqa: E402
+
+
+def measure(function):
+    """Returns the peak memory in KiB used while running a function, not counting
+    what is still allocated when it returns (eg. the sessions' new byte ranges)."""
+    tracemalloc.start()
+    function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (peak - current) / 1024
+
+
+if __name__ == "__main__":
+    print("{:>9} {:>10} {:>14} {:>12}".format("sessions", "file KiB", "to_string KiB", "write KiB"))
+    directory = tempfile.mkdtemp(prefix="bragbench")
+    for sessions in (50, 100, 200, 400, 800):
+        brag = Brag.from_string(generate_brag(users=10, sessions=sessions))
+        brag.filename = os.path.join(directory, "brag.md")
+        to_string_peak = measure(brag.to_string)
+        brag.write(cache=False)
+        brag._source_key = None
+        write_peak = measure(lambda: brag.write(cache=False))
+        size = os.path.getsize(brag.filename) / 1024
+        print("{:>9} {:>10.0f} {:>14.0f} {:>12.0f}".format(sessions, size, to_string_peak, write_peak))
+    # Writing also leaves the brag file's lock file in the directory
+    shutil.rmtree(directory)
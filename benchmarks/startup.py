@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Checks that starting brag.py and brag_mail.py stays cheap.
+
+    python benchmarks/startup.py
+
+Every check runs a command under `python -X importtime`, fails if it imports a
+module that the command has no use for, and fails if everything the command
+imports takes longer than the budget (the fastest of a few runs, so a busy
+machine doesn't fail the check). Exits with status 1 if any check fails.
+Budgets can be scaled for slow machines with --scale.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from generate import generate_brag  # noqa: E402
+
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+# Modules only some commands need
+HEAVY = ["concurrent.futures", "sqlite3", "numpy", "mandrill", "requests", "brag_stats", "brag_sqlite",
+         "brag_search", "brag_archive", "brag_watch", "socketserver"]
+
+# (name, arguments to python, modules that must not be imported, budget in ms)
+CHECKS = [
+    ("import brag", ["-c", "import brag"], HEAVY + ["argparse", "subprocess", "tempfile", "glob"], 15),
+    ("import brag_mail", ["-c", "import brag_mail"], HEAVY + ["argparse"], 20),
+    ("brag.py current", ["{brag}", "current", "-f", "{file}", "--no-daemon"], HEAVY + ["subprocess"], 20),
+    ("brag.py users -u", ["{brag}", "users", "-f", "{file}", "-u", "user 1", "--no-daemon"], HEAVY, 20),
+    ("brag.py current (daemon)", ["{brag}", "current", "-f", "{file}"], HEAVY[:-1], 30),
+    ("brag_mail.py -t", ["{mail}", "-f", "{file}", "-k", "KEY", "-t"], HEAVY, 25),
+]
+
+
+def get_imports(arguments, environment):
+    """Runs python with -X importtime.
+
+    Returns:
+        tuple -- (total import time in microseconds, set of imported modules),
+        not counting what site imported before the command ran
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime"] + arguments,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment, cwd=ROOT, check=True
+    )
+    total, modules, in_site = 0, set(), True
+    for line in process.stderr.decode('utf-8').splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is None:
+            continue
+        self_time, cumulative, indent, module = match.groups()
+        if in_site:
+            # Everything up to and including site is imported before the command runs
+            in_site = module != "site"
+            continue
+        modules.add(module)
+        if not indent:
+            total += int(cumulative)
+    return total, modules
+
+
+def run_checks(scale=1.0, repeat=5):
+    """Runs the checks.
+
+    Args:
+        scale: float -- factor for the budgets
+        repeat: int -- number of runs per check
+    Returns:
+        list of str -- the failures
+    """
+    directory = tempfile.mkdtemp(prefix="bragstartup")
+    filename = os.path.join(directory, "brag.md")
+    with open(filename, 'w') as f:
+        f.write(generate_brag(users=5, sessions=20))
+    environment = dict(os.environ, XDG_CACHE_HOME=directory, BRAG_SOCKET=os.path.join(directory, "none.sock"))
+    environment.pop('BRAG_PROFILE', None)
+    names = {'brag': os.path.join(ROOT, "brag.py"), 'mail': os.path.join(ROOT, "brag_mail.py"), 'file': filename}
+    failures = []
+    print("{:<28} {:>9} {:>9}".format("check", "ms", "budget"))
+    for name, arguments, forbidden, budget in CHECKS:
+        arguments = [argument.format(**names) for argument in arguments]
+        best = None
+        for _ in range(repeat):
+            total, modules = get_imports(arguments, environment)
+            best = total if best is None else min(best, total)
+        unwanted = sorted(module for module in forbidden if module in modules)
+        print("{:<28} {:>9.1f} {:>9.1f}".format(name, best / 1000, budget * scale))
+        if unwanted:
+            failures.append("{} imports {}".format(name, ", ".join(unwanted)))
+        if best / 1000 > budget * scale:
+            failures.append("{} takes {:.1f} ms to import, more than {:.1f} ms".format(name, best / 1000, budget * scale))
+    shutil.rmtree(directory)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--scale', type=float, default=float(os.environ.get('BRAG_STARTUP_SCALE', 1.0)),
+                        help='factor for all budgets, eg. 2 on a slow machine')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of runs per check')
+    args = parser.parse_args()
+    failures = run_checks(scale=args.scale, repeat=args.repeat)
+    if failures:
+        sys.exit("\n".join(failures))
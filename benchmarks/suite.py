@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Times the main operations on generated brags of several sizes.
+
+    python benchmarks/suite.py -o before.json
+    python benchmarks/suite.py -o after.json --compare before.json
+
+Every benchmark is warmed up and then run a few times. The fastest and median
+run are kept, along with the peak memory of a separate run under tracemalloc.
+Results are written as JSON, together with the commit they were measured at,
+so runs on different commits can be compared with --compare.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from brag import Brag, parse_changes  # noqa: E402
+from generate import generate_brag  # noqa: E402
+
+RESULTS_VERSION = 1
+# (users, sessions per user, tasks per session)
+SIZES = {
+    'small': (5, 20, 5),
+    'medium': (10, 100, 5),
+    'large': (20, 400, 6),
+}
+
+
+def get_text(size):
+    """Generates a realistic brag file of a given size: some comments, an
+    inactive user, and all list styles."""
+    users, sessions, tasks = SIZES[size]
+    return generate_brag(
+        users=users, sessions=sessions, tasks=tasks,
+        comments=0.3, inactive=max(1, users // 10), styles=("dash", "star", "number")
+    )
+
+
+def get_benchmarks(text):
+    """Returns the benchmarks for a brag file.
+
+    Each benchmark is a pair of functions: the first prepares the input without
+    being timed, the second is timed on its result.
+
+    Args:
+        text: str -- markdown of the brag
+    Returns:
+        dict -- benchmark name: (setup, run)
+    """
+    import brag_mail
+    brag = Brag.from_string(text)
+    changes = brag.get_session_template().replace("[ ]", "[X]")
+    ndjson = list(brag.iter_ndjson())
+    # A bot's batch: finish a few tasks of every user's current session and add new ones
+    batch = json.dumps([
+        {'user': user.name, 'session': user.sessions[-1].name, 'name': task.name, 'status': 'done', 'comment': 'bot'}
+        for user in brag.active_users for task in user.sessions[-1].tasks[:3]
+    ] + [
+        {'user': user.name, 'name': "Bot task {}".format(index), 'status': 'partial'}
+        for user in brag.active_users for index in range(20)
+    ])
+
+    def mail(brag):
+        with contextlib.redirect_stdout(io.StringIO()):
+            session = brag.current_session
+            reminders = [(user, brag_mail.get_tasks(user, session)) for user in brag.active_users]
+            return [brag_mail.get_message(user, tasks, brag_mail.SUBJECT) for user, tasks in reminders if tasks]
+
+    return {
+        'from_string': (lambda: text, Brag.from_string),
+        # Merges a filled-in session template, like 'brag.py run'
+        'update': (
+            lambda: (Brag.from_string(text), Brag.from_string(changes)),
+            lambda brags: brags[0].update(brags[0].diff(brags[1]))
+        ),
+        # Merges a batch of changes, like 'brag.py apply' (without writing the file)
+        'apply': (
+            lambda: Brag.from_string(text),
+            lambda brag: brag.update(brag.diff(parse_changes(batch)))
+        ),
+        'to_string': (lambda: brag, Brag.to_string),
+        'export_ndjson': (lambda: brag, lambda brag: sum(1 for line in brag.iter_ndjson())),
+        'from_ndjson': (lambda: ndjson, Brag.from_ndjson),
+        'get_session_template': (lambda: brag, Brag.get_session_template),
+        'user_stats': (lambda: brag, lambda brag: [user.stats() for user in brag.active_users]),
+        'mail': (lambda: brag, mail),
+    }
+
+
+def measure(setup, run, repeat):
+    """Times a benchmark.
+
+    Returns:
+        dict -- fastest and median time in seconds, and peak memory in KiB
+    """
+    # Warm up, eg. lazy imports and caches
+    run(setup())
+    times = []
+    for _ in range(repeat):
+        value = setup()
+        start = time.perf_counter()
+        run(value)
+        times.append(time.perf_counter() - start)
+    value = setup()
+    tracemalloc.start()
+    run(value)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'min': min(times), 'median': statistics.median(times), 'peak_kib': peak / 1024}
+
+
+def get_commit():
+    """Returns the commit of the working tree, or None outside of git."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(sizes, repeat=5, only=None):
+    """Runs the benchmarks on brags of several sizes.
+
+    Args:
+        sizes: list of str -- keys of SIZES
+        repeat: int -- number of timed runs per benchmark
+        only: list of str -- names of the benchmarks to run, or None for all
+    Returns:
+        dict -- the results, ready to be dumped as JSON
+    """
+    results = {
+        'version': RESULTS_VERSION,
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'repeat': repeat,
+        'sizes': {},
+    }
+    for size in sizes:
+        text = get_text(size)
+        users, sessions, tasks = SIZES[size]
+        size_results = results['sizes'][size] = {
+            'users': users, 'sessions': sessions, 'tasks': tasks, 'bytes': len(text.encode('utf-8')), 'benchmarks': {}
+        }
+        for name, (setup, run) in get_benchmarks(text).items():
+            if only is None or name in only:
+                size_results['benchmarks'][name] = measure(setup, run, repeat)
+    return results
+
+
+def compare(old, new, threshold=1.2):
+    """Prints how much slower or faster each benchmark got.
+
+    Args:
+        old: dict -- results of run_suite
+        new: dict -- results of run_suite
+        threshold: float -- ratio of median times above which a benchmark
+            counts as a regression
+    Returns:
+        list of str -- the regressed benchmarks, as 'size/name'
+    """
+    regressions = []
+    print("{:<30} {:>10} {:>10} {:>7}".format(
+        "{} -> {}".format(old.get('commit'), new.get('commit')), "old ms", "new ms", "ratio"
+    ))
+    for size, size_results in new['sizes'].items():
+        old_benchmarks = old['sizes'].get(size, {}).get('benchmarks', {})
+        for name, result in size_results['benchmarks'].items():
+            if name not in old_benchmarks:
+                continue
+            old_median, new_median = old_benchmarks[name]['median'], result['median']
+            ratio = new_median / old_median if old_median else float('inf')
+            label = "{}/{}".format(size, name)
+            flag = " !" if ratio > threshold else ""
+            print("{:<30} {:>10.2f} {:>10.2f} {:>6.2f}x{}".format(label, old_median * 1000, new_median * 1000, ratio, flag))
+            if ratio > threshold:
+                regressions.append(label)
+    return regressions
+
+
+def print_results(results):
+    """Prints a table of the results."""
+    print("{:<30} {:>10} {:>10} {:>10}".format("benchmark", "min ms", "median ms", "peak KiB"))
+    for size, size_results in results['sizes'].items():
+        for name, result in size_results['benchmarks'].items():
+            print("{:<30} {:>10.2f} {:>10.2f} {:>10.0f}".format(
+                "{}/{}".format(size, name), result['min'] * 1000, result['median'] * 1000, result['peak_kib']
+            ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('-s', '--sizes', default="small,medium,large",
+                        help='sizes to run, separated by commas ({})'.format(", ".join(SIZES)))
+    parser.add_argument('-b', '--benchmarks', help='only run these benchmarks, separated by commas')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed runs per benchmark')
+    parser.add_argument('-o', '--output', help='file to write the results to as JSON (- for stdout)')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown that counts as a regression with --compare (default 1.2)')
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(",")
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("unknown size '{}'".format(size))
+    results = run_suite(sizes, repeat=args.repeat, only=args.benchmarks.split(",") if args.benchmarks else None)
+    with contextlib.redirect_stdout(sys.stderr if args.output == "-" else sys.stdout):
+        print_results(results)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)
+        with contextlib.redirect_stdout(sys.stderr if args.output == "-" else sys.stdout):
+            print()
+            regressions = compare(old_results, results, threshold=args.threshold)
+        if regressions:
+            sys.exit("Slower than {}: {}".format(old_results.get('commit'), ", ".join(regressions)))
@@ -8,14 +8,21 @@ from __future__ import absolute_import
 from __future__ import division
 
 from enum import Enum
+import bisect
+import contextlib
+import functools
+import io
 import re
 import os
+import pickle
+import stat
 import sys
+import threading
+import weakref
+import brag_profile
 from datetime import datetime
-import argparse
-import tempfile
-import subprocess
-import shlex
+# Anything else is imported where it's needed, so that starting a command only
+# pays for what the command uses (see benchmarks/startup.py)
 
 __author__ = "Manuel Ebert"
 __copyright__ = "Copyright 2016, Manuel Ebert"
@@ -23,6 +30,13 @@ __date__ = "2016-02-22"
 __email__ = "manuel@1450.me"
 __version__ = "0.1.0"
 
+LIST_ITEM = re.compile(r"^ *(?:[-*]|[0-9]+\.) ")
+TASK = re.compile(r"^ *(?:[-*]|[0-9]+\.) (?:\[(.)\] +)?(?:(.*(?= -- | — )|.*)(?: -- | — )?(.*))")
+USER_HEADER = re.compile(r"[# ]*([^<]+)(?: *<)?([^>]+)?(?:> *)?(\(inactive\))?")
+CACHE_VERSION = 3
+ARCHIVE_MANIFEST = "manifest.json"
+USER_SEPARATOR = "\n\n" + "-" * 45 + "\n\n"
+
 
 def parse_sections(text, separator):
     """Separates a text into sections. For example,
@@ -45,21 +59,170 @@ def parse_sections(text, separator):
         yield text[start:end]
 
 
+def scan_user_sections(fileobj):
+    """Finds the user sections in a brag file without parsing them.
+
+    Args:
+        fileobj: file opened in binary mode
+    Returns:
+        generator -- yields (header, start, end) for each user, where header is
+        the user's header line and start and end are byte offsets into the file
+    """
+    header, start, offset = None, None, 0
+    for line in fileobj:
+        text = line if line.endswith(b"\n") else line.rstrip(b"# ")
+        if text.startswith(b"# "):
+            if header is not None:
+                yield header, start, offset
+            header, start = text.decode('utf-8').rstrip("\r\n"), offset
+        offset += len(line)
+    if header is not None:
+        yield header, start, offset
+
+
+def get_cache_path(filename):
+    """Returns the path of the parse cache for a brag file.
+
+    Caches live under $XDG_CACHE_HOME/bragmaster (~/.cache/bragmaster by default)
+    and are named after a hash of the brag file's absolute path.
+
+    Args:
+        filename: str
+    Returns:
+        str
+    """
+    import hashlib
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join("~", ".cache"))
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, "bragmaster", key + ".pickle")
+
+
+def get_lock_path(filename):
+    """Returns the path of the lock file of a brag file, eg. '.brag.md.lock' next to 'brag.md'."""
+    directory, name = os.path.split(os.path.realpath(filename))
+    return os.path.join(directory, "." + name + ".lock")
+
+
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def lock_file(filename):
+    """Holds an exclusive lock on a brag file, waiting for other processes that
+    hold it to finish.
+
+    The lock is advisory: it only keeps out other processes that lock the file,
+    ie. other brag processes writing it. It is taken on a separate lock file,
+    since writing replaces the brag file. Threads of the same process exclude
+    each other too, and a thread may take a lock it already holds. Where fcntl
+    isn't available (Windows), only threads are excluded.
+
+    Args:
+        filename: str -- path of the brag file
+    """
+    path = get_lock_path(filename)
+    with _file_locks_lock:
+        lock = _file_locks.setdefault(path, [threading.RLock(), None, 0])
+    with lock[0]:
+        if lock[2] == 0:
+            try:
+                import fcntl
+            except ImportError:
+                fcntl = None
+            if fcntl is not None:
+                f = open(path, 'a')
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                except BaseException:
+                    f.close()
+                    raise
+                lock[1] = f
+        lock[2] += 1
+        try:
+            yield
+        finally:
+            lock[2] -= 1
+            if lock[2] == 0 and lock[1] is not None:
+                # Closing the file releases the lock
+                lock[1].close()
+                lock[1] = None
+
+
+def get_archive_dir(filename):
+    """Returns the directory that 'brag.py compact' moves the old sessions of a
+    brag file to, eg. 'brag.md.archive' for 'brag.md' (see brag_archive)."""
+    return filename + ".archive"
+
+
+def get_archived_dates(filename):
+    """Returns the dates of the sessions archived from a brag file.
+
+    Args:
+        filename: str
+    Returns:
+        list of datetime -- sorted, empty if nothing was archived
+    """
+    try:
+        with open(os.path.join(get_archive_dir(filename), ARCHIVE_MANIFEST), encoding='utf-8') as f:
+            import json
+            manifest = json.load(f)
+        return sorted(set(
+            parse_session_date(date) for segment in manifest['segments'].values() for date in segment['dates']
+        ))
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def find_brag_files(path):
+    """Finds the brag files of several teams.
+
+    Args:
+        path: str -- a directory of markdown files, a glob pattern, or a single brag file
+    Returns:
+        list of str -- sorted paths, or None if path is a single brag file
+    """
+    path = os.path.expanduser(path)
+    if os.path.isfile(path):
+        # Even if its name looks like a pattern, eg. 'team[a].md'
+        return None
+    if os.path.isdir(path):
+        return sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.endswith(".md") and not name.startswith(".")
+        )
+    if any(char in path for char in "*?["):
+        import glob
+        return sorted(filename for filename in glob.glob(path) if os.path.isfile(filename))
+    return None
+
+
+def get_team_name(filename):
+    """Returns the name of the team whose brag file this is, eg. 'design' for 'brags/design.md'."""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
 def get_text_from_editor(editor='vim', template=""):
     """Opens an editor, prefills it with a template, and returns the edited text.
 
     Args:
         editor: str -- command to open the editor, eg. 'vim'
-        template: str
+        template: str or iterable of str
     Returns:
         str
     """
+    import shlex
+    import subprocess
+    import tempfile
     filehandle, tmpfile = tempfile.mkstemp(prefix="brag", text=True, suffix=".md")
-    with open(tmpfile, 'w', encoding="utf-8") as f:
-        if template:
+    with brag_profile.span("template"), open(tmpfile, 'w', encoding="utf-8") as f:
+        if isinstance(template, str):
             f.write(template)
-    subprocess.call(shlex.split(editor, posix="win" not in sys.platform) + [tmpfile])
-    with open(tmpfile, encoding="utf-8") as f:
+        else:
+            f.writelines(template)
+    with brag_profile.span("editor", editor=editor):
+        subprocess.call(shlex.split(editor, posix="win" not in sys.platform) + [tmpfile])
+    with brag_profile.span("read"), open(tmpfile, encoding="utf-8") as f:
         result = f.read()
     os.close(filehandle)
     os.remove(tmpfile)
@@ -78,9 +241,18 @@ class Status(Enum):
         """Generates a new staus from a string ('x', 'o', or ' ')"""
         if not text:
             return cls(' ')
-        else:
-            text = text.upper().replace('0', 'O')
-            return cls(text)
+        status = STATUS_SYMBOLS.get(text)
+        if status is None:
+            status = cls(text.upper().replace('0', 'O'))
+        return status
+
+    @classmethod
+    def from_name(cls, text):
+        """Returns the status with a name ('done', 'incomplete' or 'partial'),
+        or parses a symbol like from_string."""
+        if text in cls.__members__:
+            return cls[text]
+        return cls.from_string(text)
 
     def __str__(self):
         """Returns the symbol for the status"""
@@ -91,9 +263,59 @@ class Status(Enum):
         return self.value != ' '
 
 
+STATUS_SYMBOLS = {
+    ' ': Status.incomplete,
+    'X': Status.done, 'x': Status.done,
+    'O': Status.partial, 'o': Status.partial, '0': Status.partial,
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_session_date(name):
+    """Parses the date in a session's name, eg. '2016-02-06'.
+
+    Results are cached, so sessions on the same day share a datetime object.
+
+    Args:
+        name: str
+    Returns:
+        datetime or None
+    """
+    try:
+        return datetime.strptime(name.strip(), "%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def check_record(record, session=None):
+    """Checks that a task record (see Brag.iter_records) has what
+    Brag.from_records needs.
+
+    Args:
+        record: dict
+        session: str -- session for records without a "session", if any
+    Returns:
+        dict -- the record
+    Raises:
+        ValueError -- if a field is missing or has the wrong type
+    """
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+    for field in ('user', 'session', 'name', 'status', 'comment', 'email'):
+        value = record.get(field, session if field == 'session' else None)
+        if value is None and field in ('status', 'comment', 'email'):
+            continue
+        if not isinstance(value, str):
+            raise ValueError("'{}' must be a string".format(field))
+    Status.from_name(record.get('status'))
+    return record
+
+
 class Task(object):
     """Task object"""
 
+    __slots__ = ('name', 'status', 'comment')
+
     DONE = 1
     INCOMPLETE = 0
     PARTIAL = 2
@@ -106,13 +328,13 @@ class Task(object):
             status: str or Status
             comment: str
         """
-        self.name = name
-        self.status = Status.from_string(status) if not isinstance(status, Status) else status
+        self.name = sys.intern(name)
+        self.status = status if isinstance(status, Status) else Status.from_string(status)
         self.comment = comment
 
     def __bool__(self):
         """Returns true if the task is completed."""
-        return self.status == Status.done
+        return self.status is Status.done
 
     def update(self, other_task):
         """Updates the comment and status from another task."""
@@ -132,13 +354,23 @@ class Task(object):
         * Profit!!!
         """
         try:
-            status, name, comment = re.match("^ *(?:[-*]|[0-9]+\.) (?:\[(.)\] +)?(?:(.*(?= -- | — )|.*)(?: -- | — )?(.*))", line).groups()
+            status, name, comment = TASK.match(line).groups()
         except:
             return None
         if name == "...":
             return None
         return cls(name, status, comment.strip())
 
+    def to_snapshot(self):
+        """Returns the task as plain data for caching."""
+        return self.name, self.status.value, self.comment
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Creates a task from the output of to_snapshot."""
+        name, status, comment = snapshot
+        return cls(name, Status(status), comment)
+
     def __str__(self):
         """Returns a Markdown list item representation of the task."""
         return self.to_string()
@@ -160,6 +392,16 @@ class Task(object):
             result += " -- " + self.comment
         return result
 
+    def iter_markdown(self, simple=False):
+        """Yields the Markdown list item representation of the task.
+
+        Args:
+            simple: bool -- If True, omits checkboxes for unfinished tasks
+        Returns:
+            generator
+        """
+        yield self.to_string(simple=simple)
+
     def __repr__(self):
         """Returns a string representation of the task."""
         return "<[{}] {}>".format(self.status, self.name)
@@ -170,33 +412,76 @@ class Task(object):
 
 
 class Session(object):
-    """Session object. Contains task."""
+    """Session object. Contains task.
+
+    Tasks are indexed by name once a task is first looked up. Add and change
+    tasks with add_task or update (or assign a new list to Session.tasks)
+    rather than mutating the task list or tasks in place, so that Brag.write
+    knows the session has changed.
+    """
+
+    __slots__ = ('date', 'name', '_tasks', '_index', '_span')
 
     def __init__(self, name, tasks=None):
         """Initialises the session with a name and task list."""
-        try:
-            self.date = datetime.strptime(name.strip(), "%Y-%m-%d")
-        except:
-            self.date = None
-        self.name = "Goals" if "goals" in name.lower() else name.strip()
+        self.date = parse_session_date(name)
+        self.name = "Goals" if "goals" in name.lower() else sys.intern(name.strip())
         self.tasks = tasks or []
 
+    @property
+    def tasks(self):
+        """List of tasks, in order."""
+        return self._tasks
+
+    @tasks.setter
+    def tasks(self, tasks):
+        """Replaces all tasks and drops the task index."""
+        self._tasks = list(tasks)
+        self._index = None
+        self._span = None
+
+    def add_task(self, task):
+        """Appends a task to the session."""
+        self._tasks.append(task)
+        if self._index is not None:
+            self._index.setdefault(task.name, task)
+        self._span = None
+
+    @property
+    def _tasks_by_name(self):
+        """Index of tasks by name, built on first use."""
+        if self._index is None:
+            self._index = {}
+            for task in self._tasks:
+                self._index.setdefault(task.name, task)
+        return self._index
+
     @classmethod
     def from_string(cls, section_string):
         """Parses the session from a markdown string.
         The first line should contain the session name, subsequent lines a list of tasks.
         """
-        title, items = section_string.strip("# ").split("\n", 1)
-        items = filter(
-            lambda i: i is not None,
-            map(
-                Task.from_string,
-                re.findall(r"^ *(?:[-*]|[0-9]+\.) .*", items, re.MULTILINE)
-            )
-        )
-        if not items:
-            return None
-        return Session(title, list(items))
+        title, _, items = section_string.strip("# ").partition("\n")
+        tasks = []
+        for line in items.split("\n"):
+            if LIST_ITEM.match(line):
+                task = Task.from_string(line)
+                if task is not None:
+                    tasks.append(task)
+        return Session(title, tasks)
+
+    def to_snapshot(self):
+        """Returns the session as plain data for caching."""
+        return self.name, self.date, [task.to_snapshot() for task in self.tasks], self._span
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Creates a session from the output of to_snapshot without re-parsing its date."""
+        session = cls.__new__(cls)
+        session.name, session.date, tasks, span = snapshot
+        session.tasks = [Task.from_snapshot(task) for task in tasks]
+        session._span = span
+        return session
 
     def __eq__(self, other):
         """True if names match"""
@@ -212,8 +497,7 @@ class Session(object):
 
     def __str__(self):
         """Returns a Markdown representation of the session."""
-        tasks = "\n".join(map(str, self.tasks))
-        return "## {}\n\n{}".format(self.name, tasks)
+        return self.to_string()
 
     def __len__(self):
         """Returns the number of tasks in this session."""
@@ -221,26 +505,44 @@ class Session(object):
 
     def get_unfinished(self):
         """Returns a new session with only the unfinished tasks of this session."""
-        return Session(self.name, filter(lambda t: not t, self.tasks))
+        return Session(self.name, [t for t in self.tasks if not t])
 
     def __iter__(self):
         """Returns a generator that yields tasks."""
         for task in self.tasks:
             yield task
 
+    def __contains__(self, task):
+        """True if the session has a task with the same name."""
+        return task.name in self._tasks_by_name
+
     def get_task(self, name):
         """Finds a task by name"""
-        for task in self:
-            if task.name == name:
-                return task
+        return self._tasks_by_name.get(name)
+
+    def diff(self, other_session):
+        """Returns the tasks of another session that are new or have a different
+        status or comment, ie. what update would change.
+
+        Returns:
+            Session -- with the name of the other session
+        """
+        changed = []
+        for task in other_session:
+            my_task = self._tasks_by_name.get(task.name)
+            if my_task is None or my_task.status != task.status or my_task.comment != task.comment:
+                changed.append(task)
+        return Session(other_session.name, changed)
 
     def update(self, other_session):
         """Updates or adds new tasks from another session."""
         for task in other_session:
-            if task not in self:
-                self.tasks.append(task)
-            else:
-                self.get_task(task.name).update(task)
+            my_task = self._tasks_by_name.get(task.name)
+            if my_task is None:
+                self.add_task(task)
+            elif my_task.status != task.status or my_task.comment != task.comment:
+                my_task.update(task)
+                self._span = None
 
     def to_string(self, simple=False, title=True):
         """Returns a Markdown representatino of the session.
@@ -251,26 +553,157 @@ class Session(object):
         Returns:
             str
         """
-        result = "## {}\n\n".format(self.name) if title else ""
-        result += "\n".join([task.to_string(simple=simple) for task in self.tasks])
-        return result
+        return "".join(self.iter_markdown(simple=simple, title=title))
+
+    def iter_markdown(self, simple=False, title=True):
+        """Yields the Markdown representation of the session in chunks.
+
+        Args:
+            title: bool -- If True, include header for this session
+            simple: bool -- If True, omits checkboxes for unfinished tasks
+        Returns:
+            generator
+        """
+        if title:
+            yield "## {}\n\n".format(self.name)
+        for index, task in enumerate(self.tasks):
+            if index:
+                yield "\n"
+            yield from task.iter_markdown(simple=simple)
 
 
 class User(object):
-    """User Object"""
+    """User Object
+
+    Sessions are kept sorted by date and indexed by date and name. Add sessions
+    with add_session or update_session (or assign a new list to User.sessions)
+    rather than mutating the session list in place.
+    """
 
     def __init__(self, name, goals, recurring, sessions, email=None, active=True):
         """Initialises a new user."""
         self.name = name
+        self.team = None
         self.goals = goals
         self.recurring = recurring
+        self._brags = weakref.WeakSet()
         self.sessions = sessions
         self.email = email
         self.active = active
 
+    @property
+    def sessions(self):
+        """List of sessions, sorted by date. Sessions without a date come last."""
+        return self._sessions
+
+    @sessions.setter
+    def sessions(self, sessions):
+        """Replaces all sessions and rebuilds the session indexes."""
+        self._sessions = []
+        self._session_keys = []
+        self._sessions_by_date = {}
+        self._sessions_by_name = {}
+        for session in sessions:
+            self.add_session(session)
+        for brag in self._brags:
+            brag._timeline = None
+
+    def add_session(self, session):
+        """Inserts a session, keeping the sessions sorted by date."""
+        key = session.date or datetime.max
+        position = bisect.bisect_right(self._session_keys, key)
+        self._session_keys.insert(position, key)
+        self._sessions.insert(position, session)
+        self._sessions_by_date.setdefault(session.date, session)
+        self._sessions_by_name.setdefault(session.name, session)
+        for brag in self._brags:
+            brag._add_session_date(session.date)
+
+    def get_sessions(self, start=None, end=None):
+        """Returns the sessions between two dates.
+
+        Args:
+            start: datetime -- first date to include, or None for no lower bound
+            end: datetime -- last date to include, or None for no upper bound
+        Returns:
+            list of Session
+        """
+        lower = bisect.bisect_left(self._session_keys, start) if start else 0
+        upper = bisect.bisect_right(self._session_keys, end) if end else len(self._sessions)
+        return self._sessions[lower:upper]
+
+    def update_session(self, other_session):
+        """Updates the session with the same name from another session, or adds it."""
+        session = self._sessions_by_name.get(other_session.name)
+        if session is None:
+            self.add_session(other_session)
+        else:
+            session.update(other_session)
+
+    @classmethod
+    def from_sections(cls, header, sections):
+        """Creates a user from their header line and parsed sessions.
+
+        Args:
+            header: str -- eg. '# Manuel <manuel@1450.me> (inactive)'
+            sections: list of Session -- including goals and recurring tasks
+        Returns:
+            User
+        """
+        username, email, active = cls.parse_header(header)
+        sessions = []
+        goals, recurring = None, None
+        for session in sections:
+            if "goals" in session.name.lower():
+                goals = session
+            elif "recurring" in session.name.lower():
+                recurring = session
+            elif session:
+                sessions.append(session)
+        return cls(username, goals, recurring, sessions, email, active=active)
+
+    @staticmethod
+    def parse_header(header):
+        """Parses a user's header line.
+
+        Args:
+            header: str -- eg. '# Manuel <manuel@1450.me> (inactive)'
+        Returns:
+            tuple -- (name, email, active)
+        """
+        username, email, inactive = USER_HEADER.match(header).groups()
+        return username.strip(), email, not inactive
+
+    def to_snapshot(self):
+        """Returns the user as plain data for caching."""
+        return (
+            self.name, self.email, self.active,
+            self.goals.to_snapshot() if self.goals is not None else None,
+            self.recurring.to_snapshot() if self.recurring is not None else None,
+            [session.to_snapshot() for session in self.sessions]
+        )
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Creates a user from the output of to_snapshot."""
+        name, email, active, goals, recurring, sessions = snapshot
+        return cls(
+            name,
+            Session.from_snapshot(goals) if goals is not None else None,
+            Session.from_snapshot(recurring) if recurring is not None else None,
+            [Session.from_snapshot(session) for session in sessions],
+            email,
+            active=active
+        )
+
+    @property
+    def qualified_name(self):
+        """The user's name, prefixed with their team if they have one, eg. 'design/Manuel'."""
+        return self.name if self.team is None else "{}/{}".format(self.team, self.name)
+
     def __str__(self):
         """Returns a string representation of the user and their email."""
-        return "{} <{}>".format(self.name, self.email or "")
+        return "{} <{}>".format(self.qualified_name, self.email or "")
 
     def __eq__(self, other):
         """True if names match"""
@@ -278,11 +711,11 @@ class User(object):
 
     def get_last_session(self):
         """Returns the last (completed) session."""
-        return sorted(self.sessions)[-2]
+        return self.sessions[-2]
 
     def get_current_session(self):
         """Returns the current (ongoing) session."""
-        return sorted(self.sessions)[-1]
+        return self.sessions[-1]
 
     def get_session(self, date):
         """Finds a session by date."""
@@ -290,9 +723,7 @@ class User(object):
             return self.goals
         elif isinstance(date, str) and date.lower() == "recurring":
             return self.recurring
-        for session in self.sessions:
-            if date == session.date:
-                return session
+        return self._sessions_by_date.get(date)
 
     def name_and_email(self):
         """Returns a string representation of the user's name and email (if available)"""
@@ -303,53 +734,162 @@ class User(object):
 
     def to_string(self):
         """Returns a Markdown representation of all of the user's sessions."""
-        result = "# {}\n\n{}\n\n".format(self.name_and_email(), self.goals)
-        result += "\n\n".join(map(str, sorted(self.sessions)))
-        return result
+        return "".join(self.iter_markdown())
 
-    def stats(self):
-        """Returns statistics on the user.
+    def iter_markdown(self):
+        """Yields the Markdown representation of all of the user's sessions in chunks.
 
+        Returns:
+            generator
+        """
+        for piece in self._iter_pieces():
+            if isinstance(piece, Session):
+                yield from piece.iter_markdown()
+            else:
+                yield piece
+
+    def _iter_pieces(self):
+        """Yields the parts of the user's Markdown: strings and whole sessions."""
+        yield "# {}\n\n".format(self.name_and_email())
+        yield self.goals if self.goals is not None else "None"
+        yield "\n\n"
+        for index, session in enumerate(self.sessions):
+            if index:
+                yield "\n\n"
+            yield session
+
+    def stats(self, window=4):
+        """Returns statistics on the user. See brag_stats.TaskTable.user_stats.
+
+        Args:
+            window: int -- number of sessions for the rolling average
         Returns:
             dict
         """
-        tasks_completed = sum([len([t for t in session if t]) for session in self.sessions])
-        tasks_missed = sum([len([t for t in session if not t]) for session in self.sessions[:-1]])
-        return {
-            'Sessions': len(self.sessions),
-            'Goals completed': len([t for t in self.goals if t]),
-            'Total tasks': sum([len(session) for session in self.sessions]),
-            'Tasks in progress': len(self.sessions[-1]),
-            'Tasks completed': tasks_completed,
-            'Tasks missed': tasks_missed,
-            'Ratio': 0 if tasks_completed + tasks_missed == 0 else tasks_completed / (tasks_completed + tasks_missed)
-        }
+        from brag_stats import TaskTable
+        return TaskTable.from_users([self]).user_stats(window)[0]
+
+
+class LazyUser(User):
+    """A user whose goals, recurring tasks and sessions are only parsed from the
+    brag file when one of them is first accessed."""
+
+    def __init__(self, header, filename, start, end):
+        """Initialises the user from their header line and the location of their section.
+
+        Args:
+            header: str -- the user's header line
+            filename: str -- path of the brag file
+            start: int -- byte offset of the user's section
+            end: int -- byte offset of the end of the user's section
+        """
+        self.name, self.email, self.active = self.parse_header(header)
+        self.team = None
+        self._brags = weakref.WeakSet()
+        self._source = filename, start, end
+
+    def __getattr__(self, name):
+        """Parses the user's section the first time anything other than the header is needed."""
+        if name.startswith("__") or self.__dict__.get("_source") is None:
+            raise AttributeError(name)
+        self._load()
+        return getattr(self, name)
+
+    def _load(self):
+        """Parses the user's section and fills in anything that hasn't been set yet."""
+        filename, start, end = self._source
+        self._source = None
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            section = io.TextIOWrapper(io.BytesIO(f.read(end - start)), encoding='utf-8')
+        user = Brag.from_lines(section).users[0]
+        self.__dict__.setdefault("goals", user.goals)
+        self.__dict__.setdefault("recurring", user.recurring)
+        if "_sessions" not in self.__dict__:
+            self.sessions = user.sessions
+
+
+def count_loaded(brag):
+    """Counts the users, sessions, tasks and bytes of a freshly loaded brag in
+    the running profile. Users that haven't been parsed yet are only counted
+    as users."""
+    brag_profile.count("users", len(brag.users))
+    if brag._source_key is not None:
+        brag_profile.count("bytes read", brag._source_key[1])
+    users = [user for user in brag.users if user.__dict__.get("_source") is None]
+    brag_profile.count("sessions", sum(len(user.sessions) for user in users))
+    brag_profile.count("tasks", sum(len(session) for user in users for session in user.sessions))
 
 
 class Brag(object):
-    """Brag object. Contains users, each having goals and sessions, each session containing tasks."""
+    """Brag object. Contains users, each having goals and sessions, each session containing tasks.
+
+    Users are indexed by their lower-cased name. Add users with add_user (or
+    assign a new list to Brag.users) rather than mutating the user list in place.
+    The sorted dates of all sessions are kept in a timeline that is built on
+    first use and then kept up to date as users gain sessions. If only some
+    sessions were loaded, the dates of the others go into Brag.unloaded_dates
+    so that the timeline (and with it session numbers) stays complete.
+
+    A brag loaded from several files has a brag for each team in Brag.teams and
+    holds the users of all of them. It can't be written.
+    """
 
     def __init__(self):
         """Initialises the Brag."""
         self.users = []
         self.filename = None
+        self.cache_status = None
+        self.unloaded_dates = ()
+        self.teams = {}
+        self._source_key = None
+
+    @property
+    def users(self):
+        """List of users, in order."""
+        return self._users
+
+    @users.setter
+    def users(self, users):
+        """Replaces all users and rebuilds the user index. The new users and
+        their index are swapped in together, so readers see either the old or
+        the new users."""
+        users = list(users)
+        users_by_name = {}
+        for user in users:
+            users_by_name.setdefault(user.name.lower(), user)
+            if user.team is not None:
+                users_by_name.setdefault(user.qualified_name.lower(), user)
+            user._brags.add(self)
+        kept = set(map(id, users))
+        for user in getattr(self, '_users', []):
+            if id(user) not in kept:
+                user._brags.discard(self)
+        self._users, self._users_by_name = users, users_by_name
+        self._timeline = None
 
     def add_user(self, user):
         """Adds a new user to the Brag"""
-        self.users.append(user)
+        self._users.append(user)
+        self._users_by_name.setdefault(user.name.lower(), user)
+        if user.team is not None:
+            self._users_by_name.setdefault(user.qualified_name.lower(), user)
+        user._brags.add(self)
+        if self._timeline is not None:
+            for session in user.sessions:
+                self._add_session_date(session.date)
 
     def get_user(self, username):
-        """Finds a user by their name."""
-        for user in self.users:
-            if user.name.lower() == username.lower():
-                return user
+        """Finds a user by their name, or by 'team/name' if they belong to a team."""
+        return self._users_by_name.get(username.lower())
 
     @property
     def current_session(self):
         """Returns the current (ongoing) session"""
-        if not self.get_session_dates():
+        timeline = self._get_timeline()
+        if not timeline:
             return None
-        return self.get_session_dates()[-1]
+        return timeline[-1]
 
     @property
     def active_users(self):
@@ -361,9 +901,10 @@ class Brag(object):
     @property
     def last_session(self):
         """Returns the last (completed) session"""
-        if not self.get_session_dates():
+        timeline = self._get_timeline()
+        if not timeline:
             return None
-        return self.get_session_dates()[-2]
+        return timeline[-2]
 
     def session_to_string(self, date, title=True, simple=False):
         """Turns a single session into markdown
@@ -379,7 +920,7 @@ class Brag(object):
         for user in self.active_users:
             session = user.get_session(date)
             if session:
-                result += "# {}\n\n{}\n\n".format(user.name, session.to_string(title=title, simple=simple))
+                result += "# {}\n\n{}\n\n".format(user.qualified_name, session.to_string(title=title, simple=simple))
         return result.strip()
 
     def get_current_tasks(self):
@@ -392,15 +933,67 @@ class Brag(object):
         for user in self.active_users:
             yield user, user.sessions[-1]
 
+    @brag_profile.timed("to_string")
     def to_string(self):
         """Returns a markdown file for this Brag
 
         Returns:
             str
         """
-        sep = "\n\n" + "-" * 45 + "\n\n"
-        return sep.join([u.to_string() for u in self.users])
+        return "".join(self.iter_markdown())
+
+    def iter_markdown(self):
+        """Yields the markdown file for this Brag in chunks.
+
+        Returns:
+            generator
+        """
+        for index, user in enumerate(self.users):
+            if index:
+                yield USER_SEPARATOR
+            yield from user.iter_markdown()
+
+    def iter_records(self):
+        """Yields a record for every task, one user and session at a time, so
+        the markdown of the whole brag is never built. Records look like
+
+            {"user": "Manuel", "email": "manuel@1450.me", "active": true,
+             "session": "2016-02-06", "date": "2016-02-06", "status": "done",
+             "name": "Run 20k on the weekend", "comment": "Did it in 2:06:12"}
+
+        where date is None for the goals and recurring tasks, and status is the
+        name of the task's Status. Users of a team also have a "team".
 
+        Returns:
+            generator
+        """
+        for user in self.users:
+            for session in [user.goals, user.recurring] + user.sessions:
+                if session is None:
+                    continue
+                date = "{:%Y-%m-%d}".format(session.date) if session.date is not None else None
+                for task in session:
+                    record = {
+                        'user': user.name, 'email': user.email, 'active': user.active,
+                        'session': session.name, 'date': date,
+                        'status': task.status.name, 'name': task.name, 'comment': task.comment,
+                    }
+                    if user.team is not None:
+                        record['team'] = user.team
+                    yield record
+
+    def iter_ndjson(self):
+        """Yields the records of iter_records as lines of JSON (NDJSON).
+
+        Returns:
+            generator
+        """
+        import json
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        for record in self.iter_records():
+            yield encode(record) + "\n"
+
+    @brag_profile.timed("template")
     def get_session_template(self):
         """Generates a template with which the Brag can be updated.
         For each user, list their goals, last session's tasks, and a stub
@@ -409,102 +1002,702 @@ class Brag(object):
         Returns:
             str
         """
-        result = ""
-        for user in self.active_users:
-            result += "# {}\n\n".format(user.name)
-            result += user.goals.get_unfinished().to_string(simple=True) + "\n\n"
+        return "".join(self.iter_session_template())
+
+    def iter_session_template(self):
+        """Yields the template generated by get_session_template in chunks.
+
+        Returns:
+            generator
+        """
+        now = datetime.now()
+        for index, user in enumerate(self.active_users):
+            if index:
+                yield "\n\n"
+            yield "# {}\n\n".format(user.name)
+            yield from user.goals.get_unfinished().iter_markdown(simple=True)
+            yield "\n\n"
             if user.sessions:
-                result += str(sorted(user.sessions)[-1]) + "\n\n"
-            result += "## {:%Y-%m-%d}\n\n".format(datetime.now())
+                yield from user.sessions[-1].iter_markdown()
+                yield "\n\n"
+            yield "## {:%Y-%m-%d}\n\n".format(now)
             if user.recurring:
-                result += user.recurring.to_string(simple=True, title=False) + "\n"
-            result += "- ...\n\n" + "-" * 60 + "\n\n"
-
-        return result.strip()
+                yield from user.recurring.iter_markdown(simple=True, title=False)
+                yield "\n"
+            yield "- ...\n\n" + "-" * 60
 
-    def get_session_dates(self):
+    def get_session_dates(self, start=None, end=None):
         """Returns the dates of all sessions.
 
+        Args:
+            start: datetime -- first date to include, or None for no lower bound
+            end: datetime -- last date to include, or None for no upper bound
         Returns:
-            list -- list of dates.
+            list -- sorted list of dates.
         """
-        sessions = set()
-        for user in self.users:
-            for session in user.sessions:
-                sessions.add(session.date)
-        return sorted(list(sessions))
+        timeline = self._get_timeline()
+        lower = bisect.bisect_left(timeline, start) if start else 0
+        upper = bisect.bisect_right(timeline, end) if end else len(timeline)
+        return timeline[lower:upper]
+
+    def _get_timeline(self):
+        """Returns the sorted list of session dates, building it if necessary."""
+        if self._timeline is None:
+            date_counts = dict.fromkeys(self.unloaded_dates, 1)
+            for user in self.users:
+                for session in user.sessions:
+                    if session.date is not None:
+                        date_counts[session.date] = date_counts.get(session.date, 0) + 1
+            self._timeline, self._date_counts = sorted(date_counts), date_counts
+        return self._timeline
+
+    def _add_session_date(self, date):
+        """Records a new session on the timeline, if the timeline has been built."""
+        if self._timeline is None or date is None:
+            return
+        if date not in self._date_counts:
+            self._date_counts[date] = 0
+            bisect.insort(self._timeline, date)
+        self._date_counts[date] += 1
 
     @classmethod
-    def from_file(cls, filename):
+    def from_file(cls, filename, cache=True, lazy=False, workers=None):
         """Parses a markdown file into a brag.
 
+        Unless cache is False, a snapshot of the parsed brag is kept in the cache
+        directory (see get_cache_path) and reused as long as the file's size and
+        modification time are unchanged. Whether the cache was used is recorded
+        in Brag.cache_status ('hit', 'miss' or None if caching was disabled).
+
+        If lazy is True, only the user headers are read and each user is parsed
+        on first access (see LazyUser). The cache is not used in that case.
+
+        If filename is a directory or a glob pattern, all brag files it matches
+        are loaded with from_files.
+
+        Args:
+            filename: str
+            cache: bool -- If False, always parse the file and leave the cache alone
+            lazy: bool -- If True, defer parsing each user until it is needed
+            workers: int -- number of processes for loading several files
         Returns:
             Brag
         """
         filename = os.path.expanduser(filename)
-        with open(filename, encoding='utf-8') as f:
-            brag = cls.from_string(f.read())
+        filenames = find_brag_files(filename)
+        if filenames is not None:
+            brag = cls.from_files(filenames, cache=cache, workers=workers)
+            brag.filename = filename
+            return brag
+        if lazy:
+            brag = cls()
+            with brag_profile.span("scan", file=filename), open(filename, 'rb') as f:
+                for header, start, end in scan_user_sections(f):
+                    brag.add_user(LazyUser(header, filename, start, end))
+        else:
+            key = cls._get_cache_key(filename)
+            brag = None
+            if cache:
+                with brag_profile.span("load cache", file=filename):
+                    brag = cls.load_cache(filename, key)
+            if brag is not None:
+                brag.cache_status = "hit"
+            else:
+                with open(filename, encoding='utf-8') as f:
+                    brag = cls.from_lines(f)
+                if cache:
+                    brag.cache_status = "miss"
+                    brag.filename = filename
+                    with brag_profile.span("save cache", file=filename):
+                        brag.save_cache(key)
+            brag._source_key = key
         brag.filename = filename
+        if brag_profile.is_profiling():
+            count_loaded(brag)
+        # Sessions moved to the archive by 'brag.py compact' still count
+        brag.unloaded_dates = get_archived_dates(filename)
         return brag
 
+    @classmethod
+    @brag_profile.timed("load teams")
+    def from_files(cls, filenames, cache=True, workers=None):
+        """Loads the brag files of several teams into one brag.
+
+        Each file becomes a team named after the file (see get_team_name), and
+        its users are namespaced as 'team/name'. Files that aren't cached are
+        parsed in parallel processes, which hand the result back through the
+        cache (or as a snapshot if caching is disabled).
+
+        Args:
+            filenames: list of str
+            cache: bool -- If False, always parse the files and leave the cache alone
+            workers: int -- maximum number of processes, or None for one per CPU
+        Returns:
+            Brag -- with a brag for each team in Brag.teams
+        """
+        teams, uncached = {}, []
+        for filename in filenames:
+            key = cls._get_cache_key(filename)
+            team = cls.load_cache(filename, key) if cache else None
+            if team is None:
+                uncached.append(filename)
+            else:
+                team.filename, team.cache_status, team._source_key = filename, "hit", key
+                team.unloaded_dates = get_archived_dates(filename)
+                teams[filename] = team
+                if brag_profile.is_profiling():
+                    count_loaded(team)
+        workers = min(workers or os.cpu_count() or 1, len(uncached))
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(load_snapshot, uncached, [cache] * len(uncached))
+                for filename, (snapshot, cache_status, key) in zip(uncached, results):
+                    team = cls.from_snapshot(snapshot) if snapshot is not None else cls.load_cache(filename, key)
+                    if team is None:
+                        # The file changed again since the worker read it
+                        team = cls.from_file(filename, cache=cache)
+                    else:
+                        team.filename, team.cache_status, team._source_key = filename, cache_status, key
+                        team.unloaded_dates = get_archived_dates(filename)
+                        if brag_profile.is_profiling():
+                            count_loaded(team)
+                    teams[filename] = team
+        else:
+            for filename in uncached:
+                teams[filename] = cls.from_file(filename, cache=cache)
+
+        brag = cls()
+        users = []
+        for filename in filenames:
+            team_name = get_team_name(filename)
+            for user in teams[filename].users:
+                user.team = team_name
+            # Re-index the team's users under their qualified names
+            teams[filename].users = teams[filename].users
+            brag.teams[team_name] = teams[filename]
+            users.extend(teams[filename].users)
+        brag.users = users
+        brag.unloaded_dates = sorted(set().union(*(team.unloaded_dates for team in teams.values())))
+        return brag
+
+    @staticmethod
+    def _get_cache_key(filename):
+        """Returns a key that changes whenever the file is modified."""
+        file_stat = os.stat(filename)
+        return CACHE_VERSION, file_stat.st_size, file_stat.st_mtime_ns
+
+    def to_snapshot(self):
+        """Returns the brag as plain data for caching."""
+        return [user.to_snapshot() for user in self.users]
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Creates a brag from the output of to_snapshot."""
+        brag = cls()
+        for user in snapshot:
+            brag.add_user(User.from_snapshot(user))
+        return brag
+
+    @classmethod
+    def load_cache(cls, filename, key):
+        """Loads a brag from the cache if the cache matches the key.
+
+        Args:
+            filename: str -- path of the brag file
+            key: tuple -- as returned by _get_cache_key
+        Returns:
+            Brag or None
+        """
+        try:
+            with open(get_cache_path(filename), 'rb') as f:
+                if pickle.load(f) != key:
+                    return None
+                brag = cls()
+                for user in iter(lambda: pickle.load(f), None):
+                    brag.add_user(User.from_snapshot(user))
+        except Exception:
+            return None
+        return brag
+
+    def save_cache(self, key=None):
+        """Stores a snapshot of this brag in the cache. Failures are ignored.
+
+        Args:
+            key: tuple -- as returned by _get_cache_key, defaults to the current state of the file
+        """
+        import tempfile
+        cache_path = get_cache_path(self.filename)
+        tmpfile = None
+        try:
+            key = key or self._get_cache_key(self.filename)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # A temporary file of its own, since other processes may be saving the same cache
+            handle, tmpfile = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cache_path))
+            with os.fdopen(handle, 'wb') as f:
+                pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+                for user in self.users:
+                    pickle.dump(user.to_snapshot(), f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(None, f)
+            os.replace(tmpfile, cache_path)
+        except OSError:
+            pass
+        finally:
+            if tmpfile is not None and os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    @staticmethod
+    def clear_cache(filename):
+        """Removes the cached snapshot of a brag file, if there is one."""
+        try:
+            os.remove(get_cache_path(os.path.expanduser(filename)))
+        except OSError:
+            pass
+
     @classmethod
     def from_string(cls, brag_string):
         """Parses a markdown string into a brag.
 
+        Returns:
+            Brag
+        """
+        return cls.from_lines(io.StringIO(brag_string))
+
+    @classmethod
+    @brag_profile.timed("parse")
+    def from_lines(cls, lines):
+        """Parses markdown into a brag in a single pass over its lines.
+
+        Users, sessions and tasks are built as the lines stream by, so the
+        document never has to be held in memory or sliced into sections.
+
+        Args:
+            lines: iterable of str -- lines including their line endings, eg. a file
         Returns:
             Brag
         """
         brag = cls()
-        for part in parse_sections(brag_string, r'^# '):
-            header, rest = part.split("\n", 1)
-            username, email, inactive = re.match(r"[# ]*([^<]+)(?: *<)?([^>]+)?(?:> *)?(\(inactive\))?", header).groups()
+        header, title, tasks, sections = None, None, [], []
+        for line in lines:
+            if not line.endswith("\n"):
+                # The last line of a document is stripped like a section would be
+                line = line.rstrip("# ")
+            if line.startswith("# "):
+                if title is not None:
+                    sections.append(Session(title, tasks))
+                if header is not None:
+                    brag.add_user(User.from_sections(header, sections))
+                header, title, tasks, sections = line.rstrip("\n"), None, [], []
+            elif header is None:
+                continue
+            elif line.startswith("## "):
+                if title is not None:
+                    sections.append(Session(title, tasks))
+                title, tasks = line.lstrip("# ").rstrip("\n"), []
+            elif title is not None and LIST_ITEM.match(line):
+                task = Task.from_string(line.rstrip("\n"))
+                if task is not None:
+                    tasks.append(task)
+        if title is not None:
+            sections.append(Session(title, tasks))
+        if header is not None:
+            brag.add_user(User.from_sections(header, sections))
+        return brag
+
+    @classmethod
+    @brag_profile.timed("parse")
+    def from_records(cls, records, session=None):
+        """Builds a brag from task records like those of iter_records.
+
+        Records can come in any order. Users and the tasks of each session keep
+        the order they first appear in; sessions are sorted by date as usual.
+        The email and active flag of a user are taken from their first record,
+        and "team" is ignored. Users without any tasks can't be expressed as
+        records, and every user gets a goals session, even if it's empty.
+
+        Args:
+            records: iterable of dict -- needs "user", "session" and "name",
+                everything else is optional
+            session: str -- session for records without a "session", eg. '2016-02-06'
+        Returns:
+            Brag
+        """
+        users, sessions = {}, {}
+        for record in records:
+            key = record['user'].lower()
+            if key not in users:
+                users[key] = record['user'], record.get('email'), record.get('active', True), []
+            name = record['session'] if session is None else record.get('session', session)
+            task_session = sessions.get((key, name))
+            if task_session is None:
+                task_session = sessions[key, name] = Session(name)
+                users[key][3].append(task_session)
+            task_session.add_task(Task(record['name'], Status.from_name(record.get('status')), record.get('comment') or ""))
+        brag = cls()
+        for name, email, active, sections in users.values():
+            # The header comes from the records rather than a line to parse
+            user = User.from_sections("# ", sections)
+            user.name, user.email, user.active = name, email, active
+            if user.goals is None:
+                user.goals = Session("Goals")
+            brag.add_user(user)
+        return brag
+
+    @classmethod
+    def from_ndjson(cls, lines, session=None):
+        """Builds a brag from lines of JSON records (NDJSON) as written by
+        iter_ndjson, reading them one at a time. Blank lines are skipped.
+
+        Args:
+            lines: iterable of str -- eg. a file
+            session: str -- session for records without a "session", see from_records
+        Returns:
+            Brag
+        Raises:
+            ValueError -- if a line isn't a JSON object with the fields from_records needs
+        """
+        import json
+
+        def iter_records():
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield check_record(json.loads(line), session)
+                except ValueError as e:
+                    raise ValueError("Invalid record on line {}: {}".format(number, e))
+
+        return cls.from_records(iter_records(), session=session)
+
+    def filtered(self, usernames):
+        """Returns a view of this brag with only some of its users.
+
+        The view shares its users with this brag, so updates made through either
+        are visible in both. Write the original brag rather than the view.
+
+        Args:
+            usernames: list of str -- lower-cased user names, or 'team/name'
+        Returns:
+            Brag
+        """
+        brag = self.__class__()
+        brag.users = [
+            user for user in self.users
+            if user.name.lower() in usernames or user.qualified_name.lower() in usernames
+        ]
+        brag.filename = self.filename
+        brag.unloaded_dates = self.unloaded_dates
+        brag.teams = {name: team.filtered(usernames) for name, team in self.teams.items()}
+        return brag
+
+    @brag_profile.timed("diff")
+    def diff(self, other_brag):
+        """Returns the part of another brag that would change this brag when
+        passed to update: new users, new sessions, and new or changed tasks.
+
+        Returns:
+            Brag -- empty if update would be a no-op
+        """
+        brag = self.__class__()
+        for other_user in other_brag.users:
+            my_user = self.get_user(other_user.name)
+            if my_user is None:
+                brag.add_user(other_user)
+                continue
+            goals = None
+            if other_user.goals:
+                goals = my_user.goals.diff(other_user.goals) if my_user.goals is not None else other_user.goals
             sessions = []
-            goals, recurring = None, None
-            for section in parse_sections(rest, r'^## '):
-                session = Session.from_string(section)
-                if "goals" in session.name.lower():
-                    goals = session
-                elif "recurring" in session.name.lower():
-                    recurring = session
-                elif session:
-                    sessions.append(session)
-            brag.add_user(User(username.strip(), goals, recurring, sessions, email, active=not inactive))
+            for session in other_user.sessions:
+                my_session = my_user._sessions_by_name.get(session.name)
+                changed = my_session.diff(session) if my_session is not None else session
+                if changed:
+                    sessions.append(changed)
+            if goals or sessions:
+                brag.add_user(User(other_user.name, goals or None, None, sessions, other_user.email, other_user.active))
         return brag
 
+    @brag_profile.timed("update")
     def update(self, other_brag):
         """Updates from another brag."""
         for other_user in other_brag.users:
-            if other_user not in self.users:
+            my_user = self.get_user(other_user.name)
+            if my_user is None:
                 self.add_user(other_user)
             else:
-                my_user = self.users[self.users.index(other_user)]
                 if other_user.goals:
-                    my_user.goals.update(other_user.goals)
+                    if my_user.goals is None:
+                        my_user.goals = other_user.goals
+                    else:
+                        my_user.goals.update(other_user.goals)
                 for session in other_user.sessions:
-                    if session not in my_user.sessions:
-                        my_user.sessions.append(session)
+                    my_user.update_session(session)
+
+    def is_stale(self):
+        """Returns True if the brag file changed since this brag was read or written."""
+        try:
+            return self._get_cache_key(self.filename) != self._source_key
+        except OSError:
+            return self._source_key is not None
+
+    def reload(self, cache=True):
+        """Replaces the users of this brag with those in its file."""
+        brag = self.from_file(self.filename, cache=cache)
+        self.users = brag.users
+        self.unloaded_dates = brag.unloaded_dates
+        self.cache_status = brag.cache_status
+        self._source_key = brag._source_key
+
+    @contextlib.contextmanager
+    def locked(self, cache=True):
+        """Locks the brag file (see lock_file) for a read-modify-write cycle. If
+        another process changed the file since this brag was read, the brag is
+        reloaded first.
+
+        Usage:
+            with brag.locked():
+                ... change brag ...
+                brag.write()
+
+        Args:
+            cache: bool -- If False, don't use the cache when reloading
+        """
+        with lock_file(self.filename):
+            if self.is_stale():
+                self.reload(cache=cache)
+            yield
+
+    @brag_profile.timed("save")
+    def save_changes(self, changes, cache=True):
+        """Applies changes to the brag and writes it, without losing what other
+        processes wrote in the meantime.
+
+        The brag file stays locked from checking its version to writing it. If
+        another process wrote the file since this brag was read, the brag is
+        reloaded and the changes are applied to the new version instead, so both
+        processes' sessions end up in the file.
+
+        Args:
+            changes: Brag -- as returned by Brag.diff
+            cache: bool -- If True, refreshes the cache after writing
+        Returns:
+            bool -- True if the file had changed and the changes were merged into
+            the new version
+        Raises:
+            ValueError -- if the brag was loaded from several files
+        """
+        if self.teams:
+            raise ValueError("A brag of several teams can't be written, write each of Brag.teams instead")
+        with lock_file(self.filename):
+            stale = self.is_stale()
+            if stale:
+                self.reload(cache=cache)
+            self.update(changes)
+            self._write(cache)
+        return stale
+
+    @brag_profile.timed("apply")
+    def apply(self, changes, cache=True):
+        """Merges a batch of changes into the brag and writes it, in a single
+        read-merge-write cycle with the brag file locked throughout. Unlike
+        save_changes, the changes don't have to be a diff: whatever wouldn't
+        change anything is dropped, and the file isn't written at all if
+        nothing changes.
+
+        Args:
+            changes: Brag -- eg. from parse_changes, with existing users only
+            cache: bool -- If True, refreshes the cache after writing
+        Returns:
+            Brag -- what actually changed (see diff), empty if nothing did
+        Raises:
+            ValueError -- if changes has users this brag doesn't have, or the
+            brag was loaded from several files
+        """
+        if self.teams:
+            raise ValueError("A brag of several teams can't be written, write each of Brag.teams instead")
+        with lock_file(self.filename):
+            if self.is_stale():
+                self.reload(cache=cache)
+            unknown = [user.name for user in changes.users if self.get_user(user.name) is None]
+            if unknown:
+                raise ValueError("Unknown users: {}".format(", ".join(unknown)))
+            changed = self.diff(changes)
+            if changed.users:
+                self.update(changed)
+                self._write(cache)
+        return changed
+
+    @brag_profile.timed("write")
+    def write(self, cache=True):
+        """Saves the brag to file.
+
+        The brag is written to a temporary file next to the brag file, which then
+        atomically replaces it. Sessions that haven't changed since the file was
+        last written by this method are copied from the old file rather than
+        serialised again; the result is identical to writing Brag.to_string().
+
+        The file is locked while it's written (see lock_file), but whatever
+        another process wrote since this brag was read is overwritten. Use
+        save_changes to merge with it instead.
+
+        Args:
+            cache: bool -- If True, refreshes the cache so the next run doesn't re-parse the file
+        Raises:
+            ValueError -- if the brag was loaded from several files
+        """
+        if self.teams:
+            raise ValueError("A brag of several teams can't be written, write each of Brag.teams instead")
+        with lock_file(self.filename):
+            self._write(cache)
+
+    def _write(self, cache):
+        """Writes the brag to its file. See write."""
+        import tempfile
+        target = os.path.realpath(self.filename)
+        source = None
+        try:
+            if self._source_key is not None and self._get_cache_key(self.filename) == self._source_key:
+                source = open(target, 'rb')
+        except OSError:
+            pass
+        handle, tmpfile = tempfile.mkstemp(prefix=".brag", suffix=".tmp", dir=os.path.dirname(target))
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                self._write_to(f, source)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(target):
+                os.chmod(tmpfile, stat.S_IMODE(os.stat(target).st_mode))
+            os.replace(tmpfile, target)
+        except BaseException:
+            # The sessions' byte ranges now point into the temporary file
+            self._source_key = None
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        finally:
+            if source is not None:
+                source.close()
+        self._source_key = self._get_cache_key(self.filename)
+        brag_profile.count("bytes written", self._source_key[1])
+        if cache:
+            with brag_profile.span("save cache", file=self.filename):
+                self.save_cache(self._source_key)
+
+    def _write_to(self, f, source=None):
+        """Writes the markdown for this brag to a binary file and records where
+        each session ends up in it.
+
+        Args:
+            f: file opened in binary mode
+            source: file -- the brag file as last written, to copy unchanged sessions from
+        """
+        offset = 0
+        for index, user in enumerate(self.users):
+            if index:
+                data = USER_SEPARATOR.encode('utf-8')
+                f.write(data)
+                offset += len(data)
+            for piece in user._iter_pieces():
+                if not isinstance(piece, Session):
+                    data = piece.encode('utf-8')
+                else:
+                    if source is not None and piece._span is not None:
+                        start, end = piece._span
+                        source.seek(start)
+                        data = source.read(end - start)
                     else:
-                        my_user.get_session(session.date).update(session)
+                        data = "".join(piece.iter_markdown()).encode('utf-8')
+                    piece._span = offset, offset + len(data)
+                f.write(data)
+                offset += len(data)
 
-    def write(self):
-        """Saves the brag to file."""
-        with open(self.filename, 'w', encoding='utf-8') as f:
-            f.write(self.to_string())
 
-if __name__ == "__main__":
+def parse_changes(text, session=None):
+    """Parses a batch of changes for Brag.apply. The changes are either a
+    markdown fragment like the session template, or task records (see
+    Brag.iter_records) as a JSON list or NDJSON.
+
+    Args:
+        text: str
+        session: str -- session for records without a "session", today's by
+            default, like in the session template
+    Returns:
+        Brag
+    Raises:
+        ValueError -- if the JSON or a record is invalid
+    """
+    if session is None:
+        session = "{:%Y-%m-%d}".format(datetime.now())
+    stripped = text.lstrip()
+    if stripped.startswith("["):
+        import json
+        records = json.loads(text)
+        for number, record in enumerate(records, 1):
+            try:
+                check_record(record, session)
+            except ValueError as e:
+                raise ValueError("Invalid record {}: {}".format(number, e))
+        return Brag.from_records(records, session=session)
+    if stripped.startswith("{"):
+        return Brag.from_ndjson(text.splitlines(), session=session)
+    return Brag.from_string(text)
+
+
+def load_snapshot(filename, cache=True):
+    """Loads a brag file, eg. in another process, and returns it as plain data.
+    If cache is True, the brag is left in the cache instead.
+
+    Returns:
+        tuple -- (snapshot or None, cache status, source key) of the loaded brag
+    """
+    brag = Brag.from_file(filename, cache=cache)
+    return None if cache else brag.to_snapshot(), brag.cache_status, brag._source_key
+
+
+COMMANDS = {
+    'current': "Displays this week's tasks",
+    'last': "Displays last week's tasks",
+    'stats': "Displays some statistics",
+    'users': "Displays all users and their email addresses",
+    'run': "Runs a brag session by opening the editor with a template",
+    'goals': "Displays all user's goals",
+    'serve': "Keeps the brag in memory and answers other brag commands from there",
+    'import': "Copies the brag file (or -i) into the database given with -d, or merges --format ndjson records",
+    'export': "Prints the whole brag as markdown, or one JSON record per task with --format ndjson",
+    'apply': "Merges a batch of changes (markdown or JSON task records, from -i or stdin) without the editor",
+    'compact': "Moves sessions older than --before (default: a year) into the archive",
+    'search': "Finds tasks by the words in their name or comment, eg. 'search pull requests'",
+    'debug': "Random effects"
+}
+SERVED_COMMANDS = ('current', 'last', 'stats', 'users', 'goals', 'debug')
+FORMATS = ('markdown', 'ndjson')
+# Number of sessions per user that commands need from a database (None for all)
+DATABASE_SESSIONS = {'current': 1, 'last': 2, 'stats': 0, 'users': 0, 'goals': 0, 'run': 1, 'debug': 1}
+
+
+def parse_date(text):
+    """Parses a date given on the command line, eg. '2016-02-06'."""
+    return datetime.strptime(text, "%Y-%m-%d")
+
+
+def parse_window(text):
+    """Parses the number of sessions for rolling statistics, which must be at least 1."""
+    import argparse
+    window = int(text)
+    if window < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not {}".format(window))
+    return window
+
+
+def get_parser():
+    """Returns the argument parser for the command line interface."""
+    import argparse
     brag_file = os.environ.get('BRAG_FILE', None)
+    brag_db = os.environ.get('BRAG_DB', None)
     brag_editor = os.environ.get('BRAG_EDITOR', 'vim')
-    commands = {
-        'current': "Displays this week's tasks",
-        'last': "Displays last week's tasks",
-        'stats': "Displays some statistics",
-        'users': "Displays all users and their email addresses",
-        'run': "Runs a brag session by opening the editor with a template",
-        'goals': "Displays all user's goals",
-        'debug': "Random effects"
-    }
-
-    command_descriptions = '\n'.join(["  {} - {}".format(k, v) for k, v in commands.items()])
+
+    command_descriptions = '\n'.join(["  {} - {}".format(k, v) for k, v in COMMANDS.items()])
 
     parser = argparse.ArgumentParser(
         prog='brag',
@@ -512,19 +1705,43 @@ if __name__ == "__main__":
         description="""Business Re-Evaluation and Enhancement Group helper. Available commands are: \n\n""" + command_descriptions,
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('command', help='command to run', metavar='COMMAND', choices=commands.keys())
-    parser.add_argument('-f', dest='file', default=brag_file, help='path to brag file', required=not brag_file)
+    parser.add_argument('command', help='command to run', metavar='COMMAND', choices=COMMANDS.keys())
+    parser.add_argument('query', nargs='*', help='words to search for', metavar='QUERY')
+    parser.add_argument('-f', dest='file', default=brag_file, help='path to brag file')
+    parser.add_argument('-d', dest='db', default=brag_db, help='path to an SQLite database to use instead of the brag file')
     parser.add_argument('-e', dest='editor', default=brag_editor, help='editor to use for running brag')
     parser.add_argument('-u', dest='users', help='filter by users, separate multiple users with commas.')
     parser.add_argument('-i', dest='input', help='input file')
-    args = parser.parse_args()
-
-    brag = Brag.from_file(args.file)
+    parser.add_argument('-n', dest='window', type=parse_window, default=4, help='number of sessions for rolling statistics')
+    parser.add_argument('-v', dest='verbose', action='store_true', help='report whether the parse cache was used')
+    parser.add_argument('--status', choices=[status.name for status in Status], help='only search tasks with this status')
+    parser.add_argument('--since', type=parse_date, help='only search sessions on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--until', type=parse_date, help='only search sessions on or before this date (YYYY-MM-DD)')
+    parser.add_argument('--format', choices=FORMATS, default='markdown',
+                        help='format for export and import: markdown, or ndjson for one JSON record per task')
+    parser.add_argument('--before', type=parse_date, help='compact sessions before this date (YYYY-MM-DD)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='always parse the brag file')
+    parser.add_argument('--clear-cache', action='store_true', help='remove the cached brag before running')
+    parser.add_argument('--no-daemon', dest='daemon', action='store_false', help="don't ask a running 'brag serve' process")
+    parser.add_argument('--profile', nargs='?', const='1', default=os.environ.get('BRAG_PROFILE'), metavar='FILE',
+                        help='time each phase and print a summary, or write a trace (.json) or cProfile stats (.prof)')
+    return parser
+
+
+def run_command(args, brag_with_all_users, store=None):
+    """Runs a command on a brag and prints its output.
 
+    Args:
+        args: argparse.Namespace -- as parsed by get_parser
+        brag_with_all_users: Brag
+        store: brag_sqlite.SQLiteStore -- the database the brag was loaded
+            from, if any
+    """
+    brag = brag_with_all_users
     if args.users:
         usernames = args.users.lower().split(",")
-        brag.users = [u for u in brag.users if u.name.lower() in usernames]
-        brag_usernames = [u.name.lower() for u in brag.users]
+        brag = brag_with_all_users.filtered(usernames)
+        brag_usernames = [name.lower() for u in brag.users for name in (u.name, u.qualified_name)]
         for username in usernames:
             if username not in brag_usernames:
                 print("\033[93mUser '{}' not found.\033[0m".format(username))
@@ -535,7 +1752,7 @@ if __name__ == "__main__":
         print("----------")
         for user, session in brag.get_current_tasks():
             date = " ({:%d/%m})".format(session.date) if sessions[-1] != session.date else ""
-            print("* {}: {}{}".format(user.name, ", ".join(t.name for t in session.tasks), date))
+            print("* {}: {}{}".format(user.qualified_name, ", ".join(t.name for t in session.tasks), date))
 
     if args.command == "goals":
         print(brag.session_to_string(
@@ -549,18 +1766,28 @@ if __name__ == "__main__":
         print(", ".join(map(str, brag.active_users)))
 
     elif args.command == "stats":
-        usernames = [user.name for user in brag.active_users]
+        from brag_stats import TaskTable
+        if store is not None:
+            table = store.get_task_table(args.users.lower().split(",") if args.users else None)
+        else:
+            users = brag.users
+            if brag.unloaded_dates:
+                # Copies, since the brag may be the one 'brag.py serve' keeps compacted in memory
+                from brag_archive import with_archives
+                users = with_archives(brag)
+            table = TaskTable.from_users([user for user in users if user.active])
+        usernames = table.users
         username_lengths = map(len, usernames)
-        user_stats = [user.stats() for user in brag.active_users]
+        user_stats = table.user_stats(window=args.window)
         keys = user_stats[0].keys()
         longest_key = max(map(len, keys))
         print("{} {}  Total".format(" " * longest_key, "  ".join(usernames)))
         zipped = list(zip(user_stats, username_lengths))
         for key in sorted(keys):
             total = sum(stats[key] for stats in user_stats)
-            frmt = "{:{}.0%}" if key == "Ratio" else "{:>{}}"
-            if key == "Ratio":
-                total = total / len(list(brag.active_users))
+            frmt = "{:{}.0%}" if key.startswith("Ratio") else "{:>{}}"
+            if key.startswith("Ratio"):
+                total = total / len(usernames)
             formatted_stats = "  ".join([frmt.format(stats[key], length) for stats, length in zipped])
             formatted_stats += frmt.format(total, 7)
             print("{:{}} {}".format(key, longest_key, formatted_stats))
@@ -568,13 +1795,248 @@ if __name__ == "__main__":
     elif args.command == "debug":
         print(brag.get_session_template())
 
+    elif args.command == "export":
+        if store is None and brag.unloaded_dates:
+            from brag_archive import load_archives
+            load_archives(brag)
+        sys.stdout.writelines(brag.iter_ndjson() if args.format == "ndjson" else brag.iter_markdown())
+
+    elif args.command == "compact":
+        from brag_archive import compact, get_default_cutoff
+        before = args.before or get_default_cutoff(brag_with_all_users)
+        archived = compact(brag_with_all_users, before, cache=args.cache) if before else 0
+        print("Archived {} sessions.".format(archived) if archived else "Nothing to archive.")
+
     elif args.command == "run":
         new_brag = get_text_from_editor(
             editor=args.editor,
-            template=brag.get_session_template()
+            template=brag.iter_session_template()
+        )
+        changes = brag_with_all_users.diff(Brag.from_string(new_brag))
+        if changes.users:
+            if store is not None:
+                brag_with_all_users.update(changes)
+                store.save_changes(brag_with_all_users, changes)
+            elif brag_with_all_users.save_changes(changes, cache=args.cache):
+                print("The brag file changed while you were editing, your changes were merged into it.")
+        else:
+            print("Nothing changed.")
+
+
+def serve(args):
+    """Keeps the brag in memory and answers the commands of other brag processes
+    over a Unix domain socket until interrupted. Users are re-read as soon as
+    their part of the file changes (see brag_watch)."""
+    import brag_daemon
+    from brag_watch import Watcher
+    filename = os.path.abspath(os.path.expanduser(args.file))
+    parser = get_parser()
+
+    def report_change(brag, change):
+        for label, users in zip(change._fields, change):
+            if users:
+                sys.stderr.write("{}: {}\n".format(label.capitalize(), ", ".join(user.name for user in users)))
+
+    watcher = Watcher(Brag.from_file(filename, cache=args.cache), on_change=report_change if args.verbose else None)
+    # Outputs of earlier requests, so that a burst of the same query is answered
+    # once, as long as the file doesn't change
+    answers = {}
+
+    def handle(request):
+        if request.get('file') != filename:
+            return None
+        try:
+            command_args = parser.parse_args(request['argv'] + ['-f', filename])
+        except SystemExit:
+            return None
+        if command_args.command not in SERVED_COMMANDS:
+            return None
+        output = io.StringIO()
+        with watcher.lock:
+            # Don't wait for the watcher to notice a change that was just made
+            watcher.check()
+            key = watcher.key, tuple(request['argv'])
+            if key in answers:
+                return answers[key]
+            with contextlib.redirect_stdout(output):
+                run_command(command_args, watcher.brag)
+            if command_args.command != "debug":
+                # The template of 'debug' depends on the date
+                if any(old_key[0] != watcher.key for old_key in answers):
+                    answers.clear()
+                answers[key] = output.getvalue()
+        return output.getvalue()
+
+    socket_path = brag_daemon.get_socket_path(filename)
+    print("Serving {} on {}".format(filename, socket_path), file=sys.stderr)
+    watcher.start()
+    try:
+        brag_daemon.serve(socket_path, handle)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    finally:
+        watcher.stop()
+
+
+def search(args):
+    """Prints the tasks matching the search query, newest first."""
+    from brag_search import SearchIndex
+    index = SearchIndex.for_file(args.file, cache=args.cache)
+    try:
+        results = index.search(
+            " ".join(args.query),
+            usernames=args.users.lower().split(",") if args.users else None,
+            status=Status[args.status].value if args.status else None,
+            start=args.since,
+            end=args.until
         )
-        new_brag = Brag.from_string(new_brag)
+    finally:
+        index.close()
+    for document in results:
+        date = "{:%Y-%m-%d}".format(document.date) if document.date else document.session
+        print("{}  {}: {}".format(date, document.user, Task(document.name, document.status, document.comment)))
+    if not results:
+        print("Nothing found.")
+
+
+def read_ndjson(path):
+    """Builds a brag from an NDJSON file (see Brag.from_ndjson), or from stdin
+    if path is None or '-'."""
+    try:
+        if path in (None, "-"):
+            return Brag.from_ndjson(sys.stdin)
+        with open(path, encoding='utf-8') as f:
+            return Brag.from_ndjson(f)
+    except ValueError as e:
+        sys.exit("{}: {}".format(path or "stdin", e))
+
+
+def import_records(args):
+    """Merges the tasks of an NDJSON file (-i, or stdin) into the brag file
+    like a brag session would, or creates the brag file if it doesn't exist."""
+    records = read_ndjson(args.input)
+    filename = os.path.expanduser(args.file)
+    if not os.path.exists(filename):
+        records.filename = filename
+        records.write(cache=args.cache)
+        return
+    brag = Brag.from_file(filename, cache=args.cache)
+    changes = brag.diff(records)
+    if changes.users:
+        brag.save_changes(changes, cache=args.cache)
+    else:
+        print("Nothing changed.")
+
+
+def apply_changes(args):
+    """Merges a batch of changes from -i (or stdin) into the brag file, see
+    Brag.apply."""
+    if args.input in (None, "-"):
+        text = sys.stdin.read()
+    else:
+        with open(args.input, encoding='utf-8') as f:
+            text = f.read()
+    try:
+        changes = parse_changes(text)
+        changed = Brag.from_file(args.file, cache=args.cache).apply(changes, cache=args.cache)
+    except ValueError as e:
+        sys.exit("{}: {}".format(args.input or "stdin", e))
+    tasks = sum(len(session) for user in changed.users for session in [user.goals] + user.sessions if session)
+    print("Changed {} tasks of {} users.".format(tasks, len(changed.users)) if tasks else "Nothing changed.")
+
+
+def run_database_command(args):
+    """Runs a command on the SQLite database given with -d. Only the sessions the
+    command needs are loaded (see DATABASE_SESSIONS)."""
+    from brag_sqlite import SQLiteStore
+    store = SQLiteStore(args.db)
+    try:
+        if args.command == "import" and args.format == "ndjson":
+            store.import_brag(read_ndjson(args.input))
+        elif args.command == "import":
+            if not (args.input or args.file):
+                sys.exit("import needs a brag file (-f or -i)")
+            brag = Brag.from_file(args.input or args.file, cache=args.cache)
+            if brag.unloaded_dates:
+                from brag_archive import load_archives
+                load_archives(brag)
+            store.import_brag(brag)
+        elif args.command in ("serve", "search", "compact", "apply"):
+            sys.exit("{} only works with brag files".format(args.command))
+        else:
+            usernames = args.users.lower().split(",") if args.users else None
+            brag = store.load(usernames, sessions=DATABASE_SESSIONS.get(args.command))
+            run_command(args, brag, store)
+    finally:
+        store.close()
 
-        brag_with_all_users = Brag.from_file(args.file)
-        brag_with_all_users.update(new_brag)
-        brag_with_all_users.write()
+
+def main(argv=None):
+    """Runs the command line interface."""
+    argv = sys.argv[1:] if argv is None else argv
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    with brag_profile.profiled(args.profile, " ".join(["brag.py"] + argv)):
+        dispatch(parser, args, argv)
+
+
+def dispatch(parser, args, argv):
+    """Runs the command given on the command line.
+
+    Args:
+        parser: argparse.ArgumentParser -- as returned by get_parser
+        args: argparse.Namespace -- the parsed arguments
+        argv: list of str -- the raw arguments, to pass on to a running server
+    """
+    if args.query and args.command != "search":
+        parser.error("unrecognized arguments: {}".format(" ".join(args.query)))
+    if args.db:
+        run_database_command(args)
+        return
+    if not args.file:
+        parser.error("a brag file (-f) is required")
+    if args.command == "import" and args.format != "ndjson":
+        parser.error("import needs a database (-d), or --format ndjson")
+    team_files = find_brag_files(args.file)
+    single_file = ("run", "serve", "import", "apply", "compact") + (("export", ) if args.format != "ndjson" else ())
+    if team_files is not None and args.command in single_file:
+        parser.error("{} needs a single brag file".format(args.command))
+
+    if args.command == "serve":
+        serve(args)
+        return
+    if args.command == "search":
+        search(args)
+        return
+    if args.command == "import":
+        import_records(args)
+        return
+    if args.command == "apply":
+        apply_changes(args)
+        return
+
+    if team_files is None and args.command in SERVED_COMMANDS and args.daemon and not (args.clear_cache or args.verbose or args.profile):
+        import brag_daemon
+        filename = os.path.abspath(os.path.expanduser(args.file))
+        output = brag_daemon.query(brag_daemon.get_socket_path(filename), {'argv': argv, 'file': filename})
+        if output is not None:
+            sys.stdout.write(output)
+            return
+
+    if args.clear_cache:
+        for filename in team_files or [args.file]:
+            Brag.clear_cache(filename)
+    lazy = args.command not in ("run", "compact") and (bool(args.users) or args.command == "users")
+    with brag_profile.span("load", file=args.file):
+        brag = Brag.from_file(args.file, cache=args.cache, lazy=lazy)
+    if args.verbose:
+        for team in brag.teams.values() or [brag]:
+            sys.stderr.write("Cache {}: {}\n".format(team.cache_status or "disabled", get_cache_path(team.filename)))
+    with brag_profile.span(args.command):
+        run_command(args, brag)
+
+
+if __name__ == "__main__":
+    # Modules importing brag should share this module's classes
+    sys.modules.setdefault('brag', sys.modules[__name__])
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Keeps brag files small by moving old sessions into an archive.
+
+`brag.py compact` moves the sessions before a cutoff date into gzipped
+markdown segments, one per year, in a directory next to the brag file:
+
+    brag.md.archive/manifest.json
+    brag.md.archive/2016.md.gz
+
+The manifest lists the session dates in every segment, so session numbers stay
+the same without opening any segment. Commands that look at the whole history
+(stats, search, export) load the segments they need on demand.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from brag import Brag, User, ARCHIVE_MANIFEST, USER_SEPARATOR, find_brag_files, get_archive_dir, get_team_name, parse_session_date
+from datetime import timedelta
+import gzip
+import json
+import os
+import stat
+import tempfile
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, Manuel Ebert"
+__date__ = "2016-02-22"
+__email__ = "manuel@1450.me"
+
+ARCHIVE_VERSION = 1
+# Segments hold the sessions of one year each
+PERIOD = "{:%Y}"
+# Sessions per user that are never archived, so current and last keep working
+KEEP_SESSIONS = 2
+
+
+def get_manifest_key(filename):
+    """Returns a key that changes whenever the archive of a brag file changes,
+    or None if the file has no archive."""
+    try:
+        manifest_stat = os.stat(os.path.join(get_archive_dir(filename), ARCHIVE_MANIFEST))
+    except OSError:
+        return None
+    return manifest_stat.st_size, manifest_stat.st_mtime_ns
+
+
+def _replace(path, write, like, mode='wb'):
+    """Writes a file through a temporary file that atomically replaces it.
+
+    Args:
+        path: str
+        write: callable -- takes the open temporary file
+        like: str -- the file to copy permissions from, ie. the brag file
+        mode: str
+    """
+    handle, tmpfile = tempfile.mkstemp(prefix=".brag", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpfile, stat.S_IMODE(os.stat(like).st_mode))
+        os.replace(tmpfile, path)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+class Archive(object):
+    """The archived sessions of a brag file.
+
+    Segments are plain brag markdown (without goals) and are only read when
+    one of their sessions is needed.
+    """
+
+    def __init__(self, filename):
+        """Reads the manifest of a brag file's archive, if it has one.
+
+        Args:
+            filename: str -- path of the brag file
+        """
+        self.filename = filename
+        self.directory = get_archive_dir(filename)
+        self.segments = {}
+        try:
+            with open(os.path.join(self.directory, ARCHIVE_MANIFEST), encoding='utf-8') as f:
+                manifest = json.load(f)
+        except OSError:
+            return
+        if manifest.get('version') != ARCHIVE_VERSION:
+            raise ValueError("Unknown archive version in {}".format(self.directory))
+        self.segments = manifest['segments']
+
+    def __bool__(self):
+        """Returns True if any sessions were archived."""
+        return bool(self.segments)
+
+    def get_periods(self, start=None, end=None):
+        """Returns the segments with sessions between two dates.
+
+        Args:
+            start: datetime -- first date to include, or None for no lower bound
+            end: datetime -- last date to include, or None for no upper bound
+        Returns:
+            list of str -- sorted periods, eg. ['2015', '2016']
+        """
+        periods = []
+        for period, segment in sorted(self.segments.items()):
+            dates = [parse_session_date(date) for date in segment['dates']]
+            if (start is None or max(dates) >= start) and (end is None or min(dates) <= end):
+                periods.append(period)
+        return periods
+
+    def load_segment(self, period):
+        """Parses a segment.
+
+        Args:
+            period: str
+        Returns:
+            Brag -- with the archived sessions of every user, but no goals
+        """
+        path = os.path.join(self.directory, self.segments[period]['file'])
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return Brag.from_lines(f)
+
+    def add(self, period, segment):
+        """Merges sessions into a segment and rewrites it. Call save_manifest
+        once all segments are written.
+
+        Args:
+            period: str
+            segment: Brag -- the users and the sessions to add
+        """
+        if period in self.segments:
+            archived = self.load_segment(period)
+            for user in segment.users:
+                archived_user = archived.get_user(user.name)
+                if archived_user is None:
+                    archived.add_user(user)
+                else:
+                    for session in user.sessions:
+                        archived_user.update_session(session)
+            segment = archived
+        os.makedirs(self.directory, exist_ok=True)
+        filename = "{}.md.gz".format(period)
+
+        def write(f):
+            with gzip.GzipFile(filename=filename, mode='wb', fileobj=f, mtime=0) as archive:
+                for index, user in enumerate(segment.users):
+                    if index:
+                        archive.write(USER_SEPARATOR.encode('utf-8'))
+                    archive.write("# {}\n\n".format(user.name_and_email()).encode('utf-8'))
+                    archive.write("\n\n".join(session.to_string() for session in user.sessions).encode('utf-8'))
+
+        _replace(os.path.join(self.directory, filename), write, self.filename)
+        self.segments[period] = {
+            'file': filename,
+            'dates': sorted(set("{:%Y-%m-%d}".format(session.date) for user in segment.users for session in user.sessions)),
+        }
+
+    def save_manifest(self):
+        """Writes the list of segments."""
+        manifest = {'version': ARCHIVE_VERSION, 'segments': self.segments}
+        _replace(
+            os.path.join(self.directory, ARCHIVE_MANIFEST),
+            lambda f: json.dump(manifest, f, indent=2, sort_keys=True),
+            self.filename,
+            mode='w'
+        )
+
+
+def get_default_cutoff(brag):
+    """Returns the date a year before the brag's current session."""
+    dates = brag.get_session_dates()
+    return dates[-1] - timedelta(days=365) if dates else None
+
+
+def compact(brag, before, keep=KEEP_SESSIONS, cache=True):
+    """Moves the sessions before a date into the brag file's archive and writes
+    the brag. The last few sessions of every user and the sessions of the last
+    two dates on the timeline always stay in the brag file.
+
+    The segments are written before the brag file, so an interrupted compaction
+    leaves sessions in both places rather than losing them. The brag file stays
+    locked throughout, and the brag is reloaded first if the file changed.
+
+    Args:
+        brag: Brag -- loaded from a single file
+        before: datetime -- sessions before this date are archived
+        keep: int -- number of each user's sessions to keep in the brag file
+        cache: bool -- If True, refreshes the cache after writing the brag
+    Returns:
+        int -- number of sessions archived
+    """
+    with brag.locked(cache=cache):
+        return _compact(brag, before, keep, cache)
+
+
+def _compact(brag, before, keep, cache):
+    """Compacts a brag whose file is locked. See compact."""
+    dates = brag.get_session_dates()
+    if len(dates) >= 2:
+        before = min(before, dates[-2])
+    segments, users = {}, []
+    for user in brag.users:
+        candidates = user.sessions[:-keep] if keep else user.sessions
+        old = set(id(session) for session in candidates if session.date is not None and session.date < before)
+        if old:
+            users.append((user, old))
+        for session in candidates:
+            if id(session) in old:
+                segment = segments.setdefault(PERIOD.format(session.date), Brag())
+                segment_user = segment.get_user(user.name)
+                if segment_user is None:
+                    segment_user = User(user.name, None, None, [], user.email, user.active)
+                    segment.add_user(segment_user)
+                segment_user.add_session(session)
+    if not users:
+        return 0
+    archive = Archive(brag.filename)
+    for period, segment in sorted(segments.items()):
+        archive.add(period, segment)
+    archive.save_manifest()
+    for user, old in users:
+        user.sessions = [session for session in user.sessions if id(session) not in old]
+    brag.unloaded_dates = sorted(set(brag.unloaded_dates) | set(
+        parse_session_date(date) for segment in archive.segments.values() for date in segment['dates']
+    ))
+    brag._timeline = None
+    brag.write(cache=cache)
+    return sum(len(old) for user, old in users)
+
+
+def load_archives(brag, start=None, end=None):
+    """Adds the archived sessions between two dates back into a brag's users, eg.
+    for statistics over the whole history. Don't write the brag afterwards, or
+    the sessions end up in the brag file again.
+
+    Args:
+        brag: Brag -- or a view of it; sessions are only added to its users
+        start: datetime -- first date needed, or None for no lower bound
+        end: datetime -- last date needed, or None for no upper bound
+    Returns:
+        int -- number of segments loaded
+    """
+    loaded = 0
+    for team in brag.teams.values() or [brag]:
+        archive = Archive(team.filename)
+        for period in archive.get_periods(start, end):
+            for archived_user in archive.load_segment(period).users:
+                user = team.get_user(archived_user.name)
+                if user is not None:
+                    for session in archived_user.sessions:
+                        user.update_session(session)
+            loaded += 1
+    return loaded
+
+
+def with_archives(brag, start=None, end=None):
+    """Returns a brag's users with their archived sessions between two dates,
+    eg. for statistics over the whole history, without changing the brag or
+    its users. Unlike load_archives, this is safe for a brag that others are
+    reading too, like the one 'brag.py serve' keeps in memory.
+
+    Args:
+        brag: Brag -- or a view of it
+        start: datetime -- first date needed, or None for no lower bound
+        end: datetime -- last date needed, or None for no upper bound
+    Returns:
+        list of User -- in the order of Brag.users; users with archived
+        sessions are copies that share the sessions of the original
+    """
+    archived = {}
+    for team in brag.teams.values() or [brag]:
+        archive = Archive(team.filename)
+        for period in archive.get_periods(start, end):
+            for archived_user in archive.load_segment(period).users:
+                user = team.get_user(archived_user.name)
+                if user is not None:
+                    archived.setdefault(id(user), []).extend(archived_user.sessions)
+    users = []
+    for user in brag.users:
+        if id(user) in archived:
+            # Sessions still in the brag file win over archived copies
+            names = set(session.name for session in user.sessions)
+            sessions = [session for session in archived[id(user)] if session.name not in names]
+            copy = User(user.name, user.goals, user.recurring, sessions + user.sessions, user.email, user.active)
+            copy.team = user.team
+            user = copy
+        users.append(user)
+    return users
+
+
+def load_archived(filename):
+    """Loads just the archived sessions of a brag file, or of every team file if
+    filename is a directory or glob pattern, without reading the brag files.
+
+    Args:
+        filename: str
+    Returns:
+        Brag -- the users with archived sessions, in teams like Brag.from_files
+    """
+    filenames = find_brag_files(filename)
+    brag = Brag()
+    for name in [filename] if filenames is None else filenames:
+        archive = Archive(name)
+        for period in archive.get_periods():
+            for archived_user in archive.load_segment(period).users:
+                archived_user.team = None if filenames is None else get_team_name(name)
+                user = brag.get_user(archived_user.qualified_name)
+                if user is None:
+                    brag.add_user(archived_user)
+                else:
+                    for session in archived_user.sessions:
+                        user.update_session(session)
+    return brag
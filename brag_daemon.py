@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Answers brag commands from a long-running process over a Unix domain socket.
+
+The client sends a single line of JSON and reads a single line of JSON back:
+
+    {"argv": ["stats", "-u", "manuel"], "file": "/path/to/brag.md"}
+    {"output": "..."}
+
+An output of null means the server won't answer the request, and the client
+should run the command itself.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, Manuel Ebert"
+__date__ = "2016-02-22"
+__email__ = "manuel@1450.me"
+
+# Seconds a client waits for an answer before running the command itself
+TIMEOUT = 2
+# Seconds the server waits for a client to send its request
+REQUEST_TIMEOUT = 1
+# Connections waiting to be accepted, eg. when a dashboard sends a burst of queries
+REQUEST_QUEUE_SIZE = 128
+
+
+def get_socket_path(filename):
+    """Returns the path of the socket serving a brag file. Can be overridden with
+    the BRAG_SOCKET environment variable.
+
+    Args:
+        filename: str -- absolute path of the brag file
+    Returns:
+        str
+    """
+    if os.environ.get('BRAG_SOCKET'):
+        return os.environ['BRAG_SOCKET']
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        import tempfile
+        directory = tempfile.gettempdir()
+    digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(directory, "brag-{}.sock".format(digest))
+
+
+def query(socket_path, request, timeout=TIMEOUT):
+    """Sends a request to a running server.
+
+    Args:
+        socket_path: str
+        request: dict -- with the command line arguments in "argv" and the
+            absolute path of the brag file in "file"
+        timeout: float -- in seconds
+    Returns:
+        str -- the command's output, or None if no server answered; if a
+        server is running but failed to answer, the reason goes to stderr
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path)
+            client.sendall(json.dumps(request).encode('utf-8') + b"\n")
+            with client.makefile('rb') as response:
+                return json.loads(response.readline().decode('utf-8')).get('output')
+    except (FileNotFoundError, ConnectionRefusedError):
+        # No server is running
+        return None
+    except (OSError, ValueError, AttributeError) as e:
+        sys.stderr.write("The brag server didn't answer ({}), running the command without it.\n".format(
+            str(e) or type(e).__name__
+        ))
+        return None
+
+
+def is_serving(socket_path):
+    """Returns True if a server is listening on the socket."""
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(1)
+            client.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Answers a single request with the server's handler. Clients that don't
+    send their request within REQUEST_TIMEOUT are dropped."""
+
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except OSError:
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+            output = self.server.handle_request_dict(request)
+        except Exception:
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            output = None
+        self.wfile.write(json.dumps({'output': output}).encode('utf-8') + b"\n")
+
+
+class BragServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A Unix socket server that answers every connection in its own thread, so
+    a slow or idle client doesn't hold up the others. The handler has to make
+    sure it never sees a brag that's being modified, eg. by holding a lock."""
+
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def __init__(self, socket_path, handle):
+        """Binds the socket.
+
+        Args:
+            socket_path: str
+            handle: callable -- takes a request dict and returns the output as
+                str, or None if the request can't be served; may be called
+                from several threads at once
+        """
+        self.handle_request_dict = handle
+        socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+
+
+def serve(socket_path, handle):
+    """Answers requests on a socket until interrupted or terminated. A stale
+    socket left behind by a crashed server is removed first.
+
+    Args:
+        socket_path: str
+        handle: callable -- see BragServer
+    Raises:
+        RuntimeError -- if another server is already listening on the socket
+    """
+    if os.path.exists(socket_path):
+        if is_serving(socket_path):
+            raise RuntimeError("Already serving on {}".format(socket_path))
+        os.unlink(socket_path)
+    old_umask = os.umask(0o077)
+    try:
+        server = BragServer(socket_path, handle)
+    finally:
+        os.umask(old_umask)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
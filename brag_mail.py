@@ -5,10 +5,15 @@ Sends BRAG reminders via Mandrill
 """
 from __future__ import unicode_literals
 from __future__ import absolute_import
-import mandrill
 from brag import Brag
+import brag_profile
+from collections import namedtuple
 import os
-import argparse
+import json
+import re
+import sys
+import threading
+import time
 
 __author__ = "Manuel Ebert"
 __copyright__ = "Copyright 2016, Manuel Ebert"
@@ -25,9 +30,68 @@ Today is Thursday, two more days to get your shit together and be productive. Ge
 This email was automatically generated by BRAGMaster 3000 - https://github.com/maebert/bragmaster
 """
 
+SUBJECT = "Brag reminder - Session {}"
 
-def send_tasks(user, session, mandrill_client, dry_run=False):
-    """Sends email to user with their current tasks/"""
+Recipient = namedtuple('Recipient', ['name', 'email'])
+
+
+class RateLimiter(object):
+    """Spaces out calls so that no more than a given number happen per second.
+    Safe to share between threads."""
+
+    def __init__(self, rate=None):
+        """Initialises the rate limiter.
+
+        Args:
+            rate: float -- calls per second, or None for no limit
+        """
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the next call is allowed."""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_mandrill_client(api_key, concurrency=1, api_url=None):
+    """Creates a Mandrill client whose HTTP session keeps a connection open for
+    every concurrent sender.
+
+    Args:
+        api_key: str
+        concurrency: int -- number of messages sent at the same time
+        api_url: str -- root of the Mandrill API, eg. a local stand-in for testing
+    Returns:
+        mandrill.Mandrill
+    """
+    import mandrill
+    import requests
+    if api_url:
+        mandrill.ROOT = api_url.rstrip("/") + "/"
+    client = mandrill.Mandrill(api_key)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+    client.session.mount("https://", adapter)
+    client.session.mount("http://", adapter)
+    return client
+
+
+def get_tasks(user, session):
+    """Returns the tasks a user should be reminded of.
+
+    Args:
+        user: User
+        session: datetime -- date of the current session
+    Returns:
+        str -- a Markdown list of tasks, or None if the user can't be reminded
+    """
     if not user.email:
         print("No e-mail address provided for {}.".format(user.name))
         return
@@ -39,28 +103,284 @@ def send_tasks(user, session, mandrill_client, dry_run=False):
         print("  - User didn't contribute to this session")
         return
 
-    tasks = user_session.to_string(simple=True, title=False)
+    return user_session.to_string(simple=True, title=False)
+
+
+def get_message(user, tasks, subject):
+    """Creates the reminder email for a user.
 
-    message = {
+    Args:
+        user: User
+        tasks: str -- as returned by get_tasks
+        subject: str
+    Returns:
+        dict -- a Mandrill message
+    """
+    return {
         'from_email': 'manuel@1450.me',
         'from_name': 'Manuel Ebert',
         'text': TEMPLATE.format(username=user.name, tasks=tasks),
-        'subject': "Brag reminder - Session {}".format(len(brag.get_session_dates())),
+        'subject': subject,
         'to': [{'email': user.email,
                 'name': user.name,
                 'type': 'to'}]
     }
-    if not dry_run:
-        result = mandrill_client.messages.send(message=message)
-        if result[0].get("reject_reason"):
-            print("  - ERROR: {}".format(result[0]['reject_reason']))
+
+
+def get_batch_message(reminders, subject):
+    """Creates a single email that reminds several users of their tasks. Every
+    recipient only sees their own address, name and tasks, which are filled in
+    by Mandrill from per-recipient merge variables.
+
+    Args:
+        reminders: list of (User, str) -- users and their tasks as returned by get_tasks
+        subject: str
+    Returns:
+        dict -- a Mandrill message
+    """
+    return {
+        'from_email': 'manuel@1450.me',
+        'from_name': 'Manuel Ebert',
+        'text': TEMPLATE.format(username="*|USERNAME|*", tasks="*|TASKS|*"),
+        'subject': subject,
+        'to': [{'email': user.email,
+                'name': user.name,
+                'type': 'to'} for user, tasks in reminders],
+        'preserve_recipients': False,
+        'merge': True,
+        'merge_language': 'mailchimp',
+        'merge_vars': [{'rcpt': user.email,
+                        'vars': [{'name': 'USERNAME', 'content': user.name},
+                                 {'name': 'TASKS', 'content': tasks}]} for user, tasks in reminders]
+    }
+
+
+def is_retryable(error, safe=False):
+    """True if sending a message failed for a reason that may go away, eg. a
+    network error or the service being down, rather than a rejected request.
+
+    Args:
+        error: Exception
+        safe: bool -- If True, only errors that certainly happened before
+            Mandrill accepted the message count, ie. failing to connect and the
+            service being unavailable, so that retrying can't send it twice
+    """
+    import mandrill
+    import requests
+    if isinstance(error, mandrill.ServiceUnavailableError):
+        return True
+    if safe:
+        return is_connect_error(error)
+    if isinstance(error, (requests.RequestException, ValueError)):
+        return True
+    return type(error) is mandrill.Error
+
+
+def is_connect_error(error):
+    """True if a request failed because no connection could be made, ie.
+    before anything was sent."""
+    import requests
+    import urllib3
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    reason = error.args[0]
+    if isinstance(reason, urllib3.exceptions.MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def may_have_been_sent(error):
+    """True if Mandrill may have accepted a message even though sending it
+    failed, eg. because the connection dropped before Mandrill answered."""
+    import mandrill
+    if is_connect_error(error):
+        return False
+    return not isinstance(error, mandrill.Error) or type(error) is mandrill.Error
+
+
+def send_message(message, mandrill_client, rate_limiter=None, retries=3, backoff=1.0, safe=False):
+    """Sends a message, retrying with exponential backoff if sending fails temporarily.
+
+    Args:
+        message: dict -- as returned by get_message
+        mandrill_client: mandrill.Mandrill
+        rate_limiter: RateLimiter
+        retries: int -- how often to retry
+        backoff: float -- seconds to wait before the first retry; doubles with every retry
+        safe: bool -- If True, only retries if the message certainly wasn't
+            accepted, see is_retryable
+    Returns:
+        list -- the Mandrill API result, one entry per recipient
+    """
+    for attempt in range(retries + 1):
+        if rate_limiter:
+            rate_limiter.wait()
+        try:
+            with brag_profile.span("send", to=[recipient['email'] for recipient in message['to']], attempt=attempt):
+                result = mandrill_client.messages.send(message=message)
+            brag_profile.count("emails", len(message['to']))
+            return result
+        except Exception as error:
+            if attempt == retries or not is_retryable(error, safe=safe):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def send_messages(messages, mandrill_client, concurrency=4, rate=None, retries=3, backoff=1.0,
+                  before_send=None, after_send=None, safe=False):
+    """Sends messages concurrently.
+
+    Args:
+        messages: list of dict -- as returned by get_message
+        mandrill_client: mandrill.Mandrill -- shared by all senders, see get_mandrill_client
+        concurrency: int -- number of messages sent at the same time
+        rate: float -- maximum number of API calls per second, or None for no limit
+        retries: int -- how often to retry a message
+        backoff: float -- seconds to wait before the first retry
+        before_send: callable -- called with the index of a message before it is sent
+        after_send: callable -- called with the index and result of a message once it is sent
+        safe: bool -- If True, only retries if a message certainly wasn't accepted
+    Returns:
+        list -- for each message, the Mandrill API result or the exception that
+        prevented sending it
+    """
+    rate_limiter = RateLimiter(rate)
+
+    def send(index):
+        if before_send:
+            before_send(index)
+        try:
+            result = send_message(messages[index], mandrill_client, rate_limiter, retries, backoff, safe)
+        except Exception as error:
+            result = error
+        if after_send:
+            after_send(index, result)
+        return result
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        return list(executor.map(send, range(len(messages))))
+
+
+class Outbox(object):
+    """Spool directory that keeps track of which reminders of a session have been sent.
+
+    Every reminder is stored as a JSON file named after the recipient in a
+    directory named after the session date. Its state is 'pending' until it is
+    handed to Mandrill, 'sending' while Mandrill hasn't answered, and then
+    'sent', 'rejected' or 'failed'. Pending and failed reminders are sent again
+    on the next run; reminders stuck in 'sending' are not, since they may have
+    been delivered. For the same reason, a reminder is only retried within a
+    run if Mandrill certainly didn't accept it (see is_retryable).
+    """
+
+    def __init__(self, directory, session):
+        """Initialises the outbox.
+
+        Args:
+            directory: str -- root directory of the outbox
+            session: datetime -- date of the session the reminders are for
+        """
+        self.directory = os.path.join(os.path.expanduser(directory), "{:%Y-%m-%d}".format(session))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _get_path(self, name):
+        """Returns the path of a recipient's reminder."""
+        return os.path.join(self.directory, re.sub(r"[^a-z0-9]+", "-", name.lower()) + ".json")
+
+    def _load(self, path):
+        """Reads a reminder from the outbox."""
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self, entry):
+        """Writes a reminder to the outbox atomically."""
+        path = self._get_path(entry['name'])
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(path + ".tmp", path)
+
+    def add(self, user, tasks, subject):
+        """Spools a reminder unless the user's reminder is already past the pending state.
+
+        Args:
+            user: User
+            tasks: str -- as returned by get_tasks
+            subject: str
+        """
+        path = self._get_path(user.name)
+        if os.path.exists(path) and self._load(path)['state'] not in ('pending', 'failed'):
+            return
+        self._save({'name': user.name, 'email': user.email, 'tasks': tasks, 'subject': subject,
+                    'state': 'pending', 'error': None})
+
+    def entries(self):
+        """Returns all reminders in the outbox, sorted by recipient."""
+        return [self._load(os.path.join(self.directory, filename))
+                for filename in sorted(os.listdir(self.directory)) if filename.endswith(".json")]
+
+    def mark(self, recipient, state, error=None):
+        """Records the delivery state of a recipient's reminder."""
+        entry = self._load(self._get_path(recipient.name))
+        entry['state'], entry['error'] = state, error and str(error)
+        self._save(entry)
+
+
+def get_errors(users, result):
+    """Finds out which users a message could not be delivered to.
+
+    Args:
+        users: list of User -- the recipients of one message
+        result: list or Exception -- as returned by send_messages
+    Returns:
+        list -- (user, error) pairs, where error is None if the message was accepted
+    """
+    if isinstance(result, Exception):
+        return [(user, result) for user in users]
+    result = {recipient.get("email"): recipient for recipient in result}
+    errors = []
+    for user in users:
+        if user.email not in result:
+            errors.append((user, "No result from Mandrill"))
+        else:
+            errors.append((user, result[user.email].get("reject_reason")))
+    return errors
+
+
+def report_result(users, result):
+    """Prints whether sending the users their reminder worked.
+
+    Args:
+        users: list of User -- the recipients of one message
+        result: list or Exception -- as returned by send_messages
+    """
+    for user, error in get_errors(users, result):
+        if error:
+            print("- {}: ERROR: {}".format(user.name, error))
         else:
-            print("  - OK")
+            print("- {}: OK".format(user.name))
+
+
+def send_tasks(user, session, mandrill_client, dry_run=False, subject="Brag reminder"):
+    """Sends email to user with their current tasks/"""
+    tasks = get_tasks(user, session)
+    if tasks is None:
+        return
+    if not dry_run:
+        try:
+            result = send_message(get_message(user, tasks, subject), mandrill_client)
+        except Exception as error:
+            result = error
+        report_result([user], result)
     else:
         print("  - This is a dry run.")
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Sends this week's reminders from the command line."""
+    import argparse
     commands = ['current', 'last', 'template', 'stats', 'users', 'update']
     brag_file = os.environ.get('BRAG_FILE', None)
     mandrill_key = os.environ.get('MANDRILL_KEY', None)
@@ -70,17 +390,110 @@ if __name__ == "__main__":
     parser.add_argument('-k', '--key', dest="mandrill_key", default=mandrill_key, help='Mandrill API key', required=not mandrill_key)
     parser.add_argument('-u', '--users', help='Filter by users, separate multiple users with commas.')
     parser.add_argument('-t', '--try', dest="dry_run", action='store_true', help="Don't actually send mail.")
-    args = parser.parse_args()
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='Always parse the brag file.')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='Number of emails to send at the same time.')
+    parser.add_argument('-r', '--rate', type=float, help='Maximum number of emails to send per second.')
+    parser.add_argument('--retries', type=int, default=3, help='How often to retry sending an email.')
+    parser.add_argument('--api-url', default=os.environ.get('MANDRILL_API_URL'), help='Root URL of the Mandrill API.')
+    parser.add_argument('-b', '--batch', action='store_true', help='Send one email to many users with per-user merge variables.')
+    parser.add_argument('--batch-size', type=int, default=100, help='Maximum number of recipients per batched email.')
+    parser.add_argument('-o', '--outbox', default=os.environ.get('BRAG_OUTBOX'),
+                        help='Directory that records sent reminders, so that reruns only send what is left.')
+    parser.add_argument('--profile', nargs='?', const='1', default=os.environ.get('BRAG_PROFILE'), metavar='FILE',
+                        help='Time each phase and print a summary, or write a trace (.json) or cProfile stats (.prof).')
+    args = parser.parse_args(argv)
+    with brag_profile.profiled(args.profile, " ".join(["brag_mail.py"] + (sys.argv[1:] if argv is None else argv))):
+        send_reminders(args)
 
-    brag = Brag.from_file(args.file)
+
+def send_reminders(args):
+    """Sends the reminders of the current session.
+
+    Args:
+        args: argparse.Namespace -- as parsed by main
+    """
+    with brag_profile.span("load", file=args.file):
+        brag = Brag.from_file(args.file, cache=args.cache, lazy=bool(args.users))
 
     if args.users:
-        usernames = args.users.lower().split(",")
-        brag.users = [u for u in brag.users if u.name.lower() in usernames]
+        brag = brag.filtered(args.users.lower().split(","))
+
+    # Every team has its own sessions, so each gets its own reminders and outbox
+    batches, messages, outboxes = [], [], []
+    for team, team_brag in brag.teams.items() or [(None, brag)]:
+        if not team_brag.users:
+            continue
+        current_session = team_brag.current_session
+        subject = SUBJECT.format(len(team_brag.get_session_dates()))
+        if team is not None:
+            subject += " ({})".format(team)
 
-    mandrill_client = mandrill.Mandrill(args.mandrill_key)
-    current_session = max(brag.get_session_dates())
+        print("Sending '{}'".format(subject))
+        with brag_profile.span("render", team=team):
+            reminders = [(user, get_tasks(user, current_session)) for user in team_brag.users]
+        reminders = [(user, tasks) for user, tasks in reminders if tasks is not None]
+        outbox = None
+        if args.outbox and not args.dry_run:
+            outbox = Outbox(args.outbox if team is None else os.path.join(args.outbox, team), current_session)
+            for user, tasks in reminders:
+                outbox.add(user, tasks, subject)
+            # Leave the reminders of users who aren't part of this run (eg. with -u) alone
+            recipients = set(user.name for user, tasks in reminders)
+            reminders = []
+            for entry in outbox.entries():
+                if entry['name'] not in recipients:
+                    continue
+                recipient = Recipient(entry['name'], entry['email'])
+                if entry['state'] in ('pending', 'failed'):
+                    reminders.append((recipient, entry['tasks']))
+                elif entry['state'] == 'sending':
+                    print("- {}: May have been sent in an earlier run{}, not sending again.".format(
+                        recipient.name, " ({})".format(entry['error']) if entry['error'] else ""
+                    ))
+                else:
+                    print("- {}: Already {}.".format(recipient.name, entry['state']))
+        with brag_profile.span("render", team=team):
+            if args.batch:
+                team_batches = [reminders[i:i + args.batch_size] for i in range(0, len(reminders), args.batch_size)]
+                messages.extend(get_batch_message(batch, subject) for batch in team_batches)
+            else:
+                team_batches = [[reminder] for reminder in reminders]
+                messages.extend(get_message(user, tasks, subject) for user, tasks in reminders)
+        batches.extend(team_batches)
+        outboxes.extend([outbox] * len(team_batches))
+
+    if args.dry_run:
+        print("This is a dry run.")
+    else:
+        def before_send(index):
+            if outboxes[index]:
+                for recipient, tasks in batches[index]:
+                    outboxes[index].mark(recipient, 'sending')
 
-    print("Sending 'Brag reminder - Session {}'".format(len(brag.get_session_dates())))
-    for user in brag.users:
-        send_tasks(user, current_session, mandrill_client, dry_run=args.dry_run)
+        def after_send(index, result):
+            if outboxes[index]:
+                for recipient, error in get_errors([recipient for recipient, tasks in batches[index]], result):
+                    if not error:
+                        state = 'sent'
+                    elif not isinstance(error, Exception):
+                        state = 'rejected'
+                    else:
+                        # Reminders that may have been delivered are left for the next run to report
+                        state = 'sending' if may_have_been_sent(error) else 'failed'
+                    outboxes[index].mark(recipient, state, error)
+
+        # The Mandrill client is only loaded when there's something to send
+        mandrill_client = get_mandrill_client(args.mandrill_key, args.concurrency, args.api_url)
+        results = send_messages(
+            messages, mandrill_client,
+            concurrency=args.concurrency, rate=args.rate, retries=args.retries,
+            before_send=before_send, after_send=after_send,
+            # A reminder marked as sending must not be sent twice
+            safe=bool(args.outbox)
+        )
+        for batch, result in zip(batches, results):
+            report_result([user for user, tasks in batch], result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Records where the time of a brag command goes.
+
+Pass --profile to brag.py or brag_mail.py, or set BRAG_PROFILE, to time each
+phase of the command (reading and parsing the file, merging, writing,
+generating the template, sending each email) and to count the users,
+sessions, tasks and bytes it handled:
+
+    brag.py current --profile             # summary on stderr
+    brag.py current --profile trace.json  # trace for chrome://tracing or Perfetto
+    brag.py current --profile run.prof    # summary, plus cProfile stats for pstats
+
+Spans are only recorded while a profile is running; otherwise span and count
+do next to nothing.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import contextlib
+import functools
+import os
+import sys
+import threading
+import time
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, Manuel Ebert"
+__date__ = "2016-02-22"
+__email__ = "manuel@1450.me"
+
+# The running profile, if any
+current = None
+_null_span = contextlib.nullcontext()
+
+
+class Profile(object):
+    """Spans and counters recorded while running a command. Spans can be
+    recorded from several threads at once."""
+
+    def __init__(self, name):
+        """Starts the profile.
+
+        Args:
+            name: str -- what is being profiled, eg. the command line
+        """
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Times the code in the with block.
+
+        Args:
+            name: str -- name of the phase, eg. 'parse'
+            attributes: -- details to record with the span, eg. file=...
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        path = tuple(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            self.spans.append((path, start - self.start, duration, threading.get_ident(), attributes))
+
+    def count(self, name, value=1):
+        """Adds to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def stop(self):
+        """Ends the profile."""
+        self.end = time.perf_counter()
+
+    def get_summary(self):
+        """Returns the total time of each phase as a tree, with nested phases
+        indented under the phase they ran in.
+
+        Returns:
+            str
+        """
+        totals, calls, first = {}, {}, {}
+        for path, start, duration, thread, attributes in sorted(self.spans, key=lambda span: span[1]):
+            totals[path] = totals.get(path, 0) + duration
+            calls[path] = calls.get(path, 0) + 1
+            first.setdefault(path, len(first))
+        lines = ["Profile of {} ({:.1f} ms)".format(self.name, ((self.end or time.perf_counter()) - self.start) * 1000)]
+        # Phases in the order they first ran, nested phases right below their parent
+        for path in sorted(totals, key=lambda path: [first.get(path[:i + 1], -1) for i in range(len(path))]):
+            label = "  " * len(path) + path[-1]
+            lines.append("{:<32} {:>10.1f} ms {:>6}x".format(label, totals[path] * 1000, calls[path]))
+        if self.counters:
+            lines.append("  " + ", ".join("{} {}".format(name, value) for name, value in sorted(self.counters.items())))
+        return "\n".join(lines)
+
+    def get_trace(self):
+        """Returns the spans in the Trace Event Format understood by
+        chrome://tracing and Perfetto.
+
+        Returns:
+            dict
+        """
+        pid = os.getpid()
+        events = [
+            {
+                'name': path[-1], 'ph': 'X', 'pid': pid, 'tid': thread,
+                'ts': start * 1e6, 'dur': duration * 1e6, 'args': attributes,
+            }
+            for path, start, duration, thread, attributes in self.spans
+        ]
+        if self.counters:
+            events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'ts': 0, 'args': self.counters})
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'command': self.name, 'counters': self.counters},
+        }
+
+
+def span(name, **attributes):
+    """Times a phase of the running profile, if any.
+
+    Usage:
+        with span('parse', file=filename):
+            ...
+    """
+    if current is None:
+        return _null_span
+    return current.span(name, **attributes)
+
+
+def timed(name):
+    """Decorates a function so that every call is timed as a span.
+
+    Args:
+        name: str -- name of the span
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if current is None:
+                return function(*args, **kwargs)
+            with current.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """Adds to a counter of the running profile, if any."""
+    if current is not None:
+        current.count(name, value)
+
+
+def is_profiling():
+    """Returns True while a profile is running, eg. to skip counting otherwise."""
+    return current is not None
+
+
+@contextlib.contextmanager
+def profiled(target, name):
+    """Profiles the code in the with block and reports the profile at the end.
+
+    Args:
+        target: str -- where to report: None, '' or '0' to not profile at all,
+            a path ending in '.json' for a trace, a path ending in '.prof' for
+            cProfile stats and a summary on stderr, or anything else (eg. '1')
+            for just the summary
+        name: str -- what is being profiled, eg. the command line
+    """
+    global current
+    if not target or target.lower() in ("0", "false"):
+        yield
+        return
+    profiler = None
+    if target.endswith(".prof"):
+        import cProfile
+        profiler = cProfile.Profile()
+    current = Profile(name)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        profile, current = current, None
+        profile.stop()
+        if target.endswith(".json"):
+            import json
+            with open(target, 'w') as f:
+                json.dump(profile.get_trace(), f)
+        else:
+            sys.stderr.write(profile.get_summary() + "\n")
+        if profiler is not None:
+            profiler.dump_stats(target)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Full-text search over the tasks of a BRAG.
+
+The index maps every word in a task's name or comment to the tasks containing
+it. It lives in an SQLite file next to the parse cache, so a search only reads
+the postings of its own words. Whenever the brag file changes, only sessions
+whose tasks changed are indexed again. Archived sessions (see brag_archive) are
+indexed on their own and only read again when the archive changes.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from brag import Brag, find_brag_files, get_cache_path
+from brag_archive import get_manifest_key, load_archived
+from collections import namedtuple
+from datetime import datetime
+import hashlib
+import json
+import os
+import re
+import sqlite3
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, Manuel Ebert"
+__date__ = "2016-02-22"
+__email__ = "manuel@1450.me"
+
+INDEX_VERSION = 2
+# Where an indexed session comes from
+LIVE = 'file'
+ARCHIVED = 'archive'
+WORD = re.compile(r"\w+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint BLOB NOT NULL,
+    user TEXT NOT NULL,
+    username TEXT NOT NULL,
+    name TEXT NOT NULL,
+    date TEXT,
+    UNIQUE (source, key)
+);
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions (id),
+    position INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    name TEXT NOT NULL,
+    comment TEXT
+);
+CREATE TABLE IF NOT EXISTS postings (
+    word TEXT NOT NULL,
+    document_id INTEGER NOT NULL REFERENCES documents (id),
+    PRIMARY KEY (word, document_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS documents_session ON documents (session_id);
+CREATE INDEX IF NOT EXISTS postings_document ON postings (document_id);
+CREATE INDEX IF NOT EXISTS sessions_date ON sessions (date);
+"""
+
+Document = namedtuple('Document', ['user', 'session', 'date', 'status', 'name', 'comment'])
+
+
+def tokenize(text):
+    """Returns the set of lower-cased words in a text."""
+    return set(word.lower() for word in WORD.findall(text or ""))
+
+
+def get_index_path(filename):
+    """Returns the path of the search index for a brag file (or directory of files)."""
+    return os.path.splitext(get_cache_path(filename))[0] + ".search.sqlite"
+
+
+def get_source_key(filename):
+    """Returns a key that changes whenever the brag file, or any of the team files
+    it stands for, is modified."""
+    filenames = find_brag_files(filename)
+    if filenames is None:
+        return Brag._get_cache_key(filename)
+    return [[name, Brag._get_cache_key(name)] for name in filenames]
+
+
+def get_archive_key(filename):
+    """Returns a key that changes whenever the archive of the brag file, or of
+    any of the team files it stands for, is modified."""
+    filenames = find_brag_files(filename)
+    if filenames is None:
+        return get_manifest_key(filename)
+    return [[name, get_manifest_key(name)] for name in filenames]
+
+
+def get_fingerprint(session):
+    """Returns a digest of the tasks of a session."""
+    digest = hashlib.sha1()
+    for task in session:
+        digest.update("\x1f".join((task.name, task.status.value, task.comment or "")).encode('utf-8'))
+        digest.update(b"\x1e")
+    return digest.digest()
+
+
+class SearchIndex(object):
+    """An inverted index from words to the tasks containing them.
+
+    Every indexed session is stored with the fingerprint of its tasks, so that
+    update only has to index the sessions that changed. Sessions in the brag
+    file and archived sessions are updated separately. If a session is in both,
+    eg. after an interrupted compaction, only the one in the brag file is found.
+    """
+
+    def __init__(self, path):
+        """Opens the index, creating it if it doesn't exist or was made by
+        another version of this module.
+
+        Args:
+            path: str -- path of the index file, or ':memory:'
+        """
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+                for table in ("postings", "documents", "sessions", "meta"):
+                    self.connection.execute("DROP TABLE IF EXISTS {}".format(table))
+                self.connection.execute("PRAGMA user_version = {:d}".format(INDEX_VERSION))
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        """Closes the index."""
+        self.connection.close()
+
+    @classmethod
+    def for_file(cls, filename, cache=True):
+        """Returns the up-to-date index for a brag file, loading the brag only
+        if the file changed since the index was last updated, and the archive
+        only if the archive changed.
+
+        Args:
+            filename: str -- a brag file, or a directory or glob of team files
+            cache: bool -- If False, build a throwaway index in memory and leave
+                the caches alone
+        Returns:
+            SearchIndex
+        """
+        filename = os.path.expanduser(filename)
+        index = cls(get_index_path(filename) if cache else ":memory:")
+        archive_key = json.dumps(get_archive_key(filename))
+        if index.get_meta('archive_key') != archive_key:
+            index.update(load_archived(filename), source=ARCHIVED)
+            index.set_meta('archive_key', archive_key)
+        key = json.dumps(get_source_key(filename))
+        if index.get_meta('key') != key:
+            index.update(Brag.from_file(filename, cache=cache))
+            index.set_meta('key', key)
+        return index
+
+    def get_meta(self, name):
+        """Returns a value stored with set_meta, or None."""
+        row = self.connection.execute("SELECT value FROM meta WHERE name = ?", (name, )).fetchone()
+        return row and row[0]
+
+    def set_meta(self, name, value):
+        """Stores a value in the index."""
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    def update(self, brag, source=LIVE):
+        """Brings the index up to date with a brag in a single transaction.
+
+        Args:
+            brag: Brag
+            source: str -- LIVE for the sessions in the brag file, or ARCHIVED
+                for the archived ones; sessions from the other source are kept
+        Returns:
+            tuple -- number of sessions (indexed, dropped)
+        """
+        known = {key: (session_id, fingerprint) for session_id, key, fingerprint in
+                 self.connection.execute("SELECT id, key, fingerprint FROM sessions WHERE source = ?", (source, ))}
+        seen, indexed = set(), 0
+        with self.connection:
+            for user in brag.users:
+                for session in [user.goals] + list(user.sessions):
+                    if session is None:
+                        continue
+                    key = [user.qualified_name, session.name]
+                    while json.dumps(key) in seen:
+                        # Users or sessions with the same name
+                        key.append(len(key))
+                    key = json.dumps(key)
+                    seen.add(key)
+                    fingerprint = get_fingerprint(session)
+                    session_id, old_fingerprint = known.pop(key, (None, None))
+                    if old_fingerprint == fingerprint:
+                        continue
+                    if session_id is not None:
+                        self._remove(session_id)
+                    self._add(source, key, fingerprint, user, session)
+                    indexed += 1
+            for session_id, fingerprint in known.values():
+                self._remove(session_id)
+        return indexed, len(known)
+
+    def _add(self, source, key, fingerprint, user, session):
+        """Indexes a session and its tasks."""
+        cursor = self.connection.execute(
+            "INSERT INTO sessions (source, key, fingerprint, user, username, name, date) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (source, key, fingerprint, user.qualified_name, user.name.lower(), session.name,
+             session.date.isoformat(" ") if session.date is not None else None)
+        )
+        session_id = cursor.lastrowid
+        postings = []
+        for position, task in enumerate(session):
+            cursor = self.connection.execute(
+                "INSERT INTO documents (session_id, position, status, name, comment) VALUES (?, ?, ?, ?, ?)",
+                (session_id, position, task.status.value, task.name, task.comment)
+            )
+            postings.extend((word, cursor.lastrowid) for word in tokenize(task.name) | tokenize(task.comment))
+        self.connection.executemany("INSERT INTO postings (word, document_id) VALUES (?, ?)", postings)
+
+    def _remove(self, session_id):
+        """Removes a session and its tasks from the index."""
+        self.connection.execute(
+            "DELETE FROM postings WHERE document_id IN (SELECT id FROM documents WHERE session_id = ?)", (session_id, )
+        )
+        self.connection.execute("DELETE FROM documents WHERE session_id = ?", (session_id, ))
+        self.connection.execute("DELETE FROM sessions WHERE id = ?", (session_id, ))
+
+    def search(self, query, usernames=None, status=None, start=None, end=None):
+        """Finds the tasks that contain every word of a query.
+
+        Args:
+            query: str
+            usernames: list of str -- lower-cased user names (or 'team/name') to
+                limit the results to, or None for all users
+            status: str -- only return tasks with this status value ('X', 'O' or ' ')
+            start: datetime -- earliest session date, or None for no lower bound
+            end: datetime -- latest session date, or None for no upper bound
+        Returns:
+            list of Document -- newest first, goals last, then by user and position
+        """
+        words = sorted(tokenize(query))
+        if not words:
+            return []
+        conditions = [
+            "documents.id IN (SELECT document_id FROM postings WHERE word IN ({}) "
+            "GROUP BY document_id HAVING COUNT(*) = ?)".format(", ".join("?" * len(words)))
+        ]
+        parameters = words + [len(words)]
+        # Sessions that are still in the brag file win over archived copies
+        conditions.append(
+            "NOT (sessions.source = ? AND EXISTS "
+            "(SELECT 1 FROM sessions AS live WHERE live.source = ? AND live.key = sessions.key))"
+        )
+        parameters.extend([ARCHIVED, LIVE])
+        if usernames is not None:
+            marks = ", ".join("?" * len(usernames))
+            conditions.append("(lower(sessions.user) IN ({0}) OR sessions.username IN ({0}))".format(marks))
+            parameters.extend(list(usernames) * 2)
+        if status is not None:
+            conditions.append("documents.status = ?")
+            parameters.append(status)
+        if start is not None:
+            conditions.append("sessions.date >= ?")
+            parameters.append(start.isoformat(" "))
+        if end is not None:
+            conditions.append("sessions.date <= ?")
+            parameters.append(end.isoformat(" "))
+        rows = self.connection.execute(
+            "SELECT sessions.user, sessions.name, sessions.date, documents.status, documents.name, documents.comment "
+            "FROM documents JOIN sessions ON documents.session_id = sessions.id WHERE {} "
+            "ORDER BY sessions.date IS NULL, sessions.date DESC, sessions.key, documents.position".format(" AND ".join(conditions)),
+            parameters
+        )
+        return [
+            Document(user, session, datetime.fromisoformat(date) if date is not None else None, status, name, comment)
+            for user, session, date, status, name, comment in rows
+        ]
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Stores BRAGs in an SQLite database instead of a markdown file.
+
+Queries only load the sessions they need, and changes are written one session
+at a time. Import a brag file with `brag.py import -d DB -f FILE` and get it
+back with `brag.py export -d DB`.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from brag import Brag, User, parse_session_date
+from datetime import datetime
+import sqlite3
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, Manuel Ebert"
+__date__ = "2016-02-22"
+__email__ = "manuel@1450.me"
+
+GOALS = "goals"
+RECURRING = "recurring"
+SESSION = "session"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    email TEXT,
+    active INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    date TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions (id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    comment TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_name ON users (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS sessions_user_date ON sessions (user_id, kind, date);
+CREATE INDEX IF NOT EXISTS sessions_date ON sessions (date);
+CREATE INDEX IF NOT EXISTS tasks_session ON tasks (session_id, position);
+"""
+
+# Orders the sessions of a user like User.sessions: by date, undated sessions last
+SESSION_ORDER = "sessions.date IS NULL, sessions.date, sessions.position"
+
+
+class SQLiteStore(object):
+    """A brag stored in an SQLite database.
+
+    Users are kept in the order of the brag file. Each user has at most one goals
+    and one recurring session and any number of dated sessions, stored in the
+    sessions table with the kind 'goals', 'recurring' or 'session'.
+    """
+
+    def __init__(self, path):
+        """Opens the database, creating its tables if necessary.
+
+        Args:
+            path: str -- path of the database file
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        """Closes the database."""
+        self.connection.close()
+
+    def import_brag(self, brag):
+        """Replaces everything in the database with a brag in a single transaction.
+
+        Args:
+            brag: Brag
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM tasks")
+            self.connection.execute("DELETE FROM sessions")
+            self.connection.execute("DELETE FROM users")
+            for position, user in enumerate(brag.users):
+                self._insert_user(user, position)
+
+    def _insert_user(self, user, position):
+        """Inserts a user and all of their sessions."""
+        cursor = self.connection.execute(
+            "INSERT INTO users (position, name, email, active) VALUES (?, ?, ?, ?)",
+            (position, user.name, user.email, user.active)
+        )
+        user_id = cursor.lastrowid
+        if user.goals is not None:
+            self._insert_session(user_id, GOALS, 0, user.goals)
+        if user.recurring is not None:
+            self._insert_session(user_id, RECURRING, 0, user.recurring)
+        for position, session in enumerate(user.sessions):
+            self._insert_session(user_id, SESSION, position, session)
+        return user_id
+
+    def _insert_session(self, user_id, kind, position, session):
+        """Inserts a session and its tasks."""
+        date = session.date.isoformat(" ") if session.date is not None else None
+        cursor = self.connection.execute(
+            "INSERT INTO sessions (user_id, kind, position, name, date) VALUES (?, ?, ?, ?, ?)",
+            (user_id, kind, position, session.name, date)
+        )
+        self._insert_tasks(cursor.lastrowid, session)
+
+    def _insert_tasks(self, session_id, session):
+        """Inserts the tasks of a session."""
+        self.connection.executemany(
+            "INSERT INTO tasks (session_id, position, name, status, comment) VALUES (?, ?, ?, ?, ?)",
+            [(session_id, position, task.name, task.status.value, task.comment) for position, task in enumerate(session)]
+        )
+
+    def _get_users(self, usernames=None, active_only=False):
+        """Returns (id, name, email, active) for some users, in order.
+
+        Args:
+            usernames: list of str -- lower-cased user names, or None for all users
+            active_only: bool -- If True, leave out inactive users
+        Returns:
+            list of tuple
+        """
+        query = "SELECT id, name, email, active FROM users"
+        conditions, parameters = [], []
+        if usernames is not None:
+            conditions.append("lower(name) IN ({})".format(", ".join("?" * len(usernames))))
+            parameters.extend(usernames)
+        if active_only:
+            conditions.append("active")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self.connection.execute(query + " ORDER BY position", parameters).fetchall()
+
+    def load(self, usernames=None, sessions=None):
+        """Loads a brag from the database.
+
+        Args:
+            usernames: list of str -- lower-cased user names, or None for all users
+            sessions: int -- number of sessions to load per user (on top of goals
+                and recurring tasks), or None for all of them. The dates of the
+                others are recorded in Brag.unloaded_dates.
+        Returns:
+            Brag
+        """
+        users = self._get_users(usernames)
+        user_ids = [row[0] for row in users]
+        if sessions is None:
+            condition = "" if usernames is None else " WHERE user_id IN ({})".format(", ".join(map(str, user_ids)))
+            session_rows = self.connection.execute(
+                "SELECT id, user_id, kind, name FROM sessions{} ORDER BY {}".format(condition, SESSION_ORDER)
+            ).fetchall()
+            selected = "SELECT id FROM sessions{}".format(condition)
+        else:
+            session_rows = []
+            for user_id in user_ids:
+                session_rows.extend(self.connection.execute(
+                    "SELECT id, user_id, kind, name FROM sessions WHERE user_id = ? AND kind != 'session'", (user_id, )
+                ))
+                recent = self.connection.execute(
+                    "SELECT id, user_id, kind, name FROM sessions WHERE user_id = ? AND kind = 'session' "
+                    "ORDER BY sessions.date IS NULL DESC, sessions.date DESC, sessions.position DESC LIMIT ?",
+                    (user_id, sessions)
+                ).fetchall()
+                session_rows.extend(reversed(recent))
+            selected = ", ".join(str(row[0]) for row in session_rows)
+        tasks = {}
+        task_rows = self.connection.execute(
+            "SELECT session_id, name, status, comment FROM tasks WHERE session_id IN ({}) "
+            "ORDER BY session_id, position".format(selected)
+        )
+        for session_id, name, status, comment in task_rows:
+            tasks.setdefault(session_id, []).append((name, status, comment))
+
+        snapshots = {user_id: [None, None, []] for user_id in user_ids}
+        for session_id, user_id, kind, name in session_rows:
+            snapshot = name, parse_session_date(name), tasks.get(session_id, []), None
+            if kind == GOALS:
+                snapshots[user_id][0] = snapshot
+            elif kind == RECURRING:
+                snapshots[user_id][1] = snapshot
+            else:
+                snapshots[user_id][2].append(snapshot)
+
+        brag = Brag()
+        brag.users = [
+            User.from_snapshot((name, email, bool(active)) + tuple(snapshots[user_id]))
+            for user_id, name, email, active in users
+        ]
+        if sessions is not None:
+            query = "SELECT DISTINCT date FROM sessions WHERE kind = 'session' AND date IS NOT NULL"
+            if usernames is not None:
+                query += " AND user_id IN ({})".format(", ".join(map(str, user_ids)))
+            # Includes the dates of the loaded sessions, which doesn't change the timeline
+            brag.unloaded_dates = [datetime.fromisoformat(date) for (date, ) in self.connection.execute(query)]
+        return brag
+
+    def save_changes(self, brag, changes):
+        """Stores the changes made to a brag loaded from the database, one user or
+        session per transaction.
+
+        Args:
+            brag: Brag -- after brag.update(changes)
+            changes: Brag -- as returned by Brag.diff
+        """
+        for changed_user in changes.users:
+            user = brag.get_user(changed_user.name)
+            row = self.connection.execute(
+                "SELECT id FROM users WHERE name = ? COLLATE NOCASE ORDER BY position LIMIT 1", (user.name, )
+            ).fetchone()
+            if row is None:
+                with self.connection:
+                    position = self.connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM users").fetchone()[0]
+                    self._insert_user(user, position)
+                continue
+            user_id = row[0]
+            if changed_user.goals:
+                self.save_session(user_id, GOALS, user.goals)
+            for changed_session in changed_user.sessions:
+                self.save_session(user_id, SESSION, user._sessions_by_name[changed_session.name])
+
+    def save_session(self, user_id, kind, session):
+        """Replaces a session's tasks, or adds the session, in a single transaction.
+
+        Args:
+            user_id: int
+            kind: str -- 'goals', 'recurring' or 'session'
+            session: Session
+        """
+        with self.connection:
+            query = "SELECT id FROM sessions WHERE user_id = ? AND kind = ?"
+            parameters = [user_id, kind]
+            if kind == SESSION:
+                query += " AND name = ?"
+                parameters.append(session.name)
+            row = self.connection.execute(query + " ORDER BY position LIMIT 1", parameters).fetchone()
+            if row is None:
+                position = self.connection.execute(
+                    "SELECT COALESCE(MAX(position) + 1, 0) FROM sessions WHERE user_id = ? AND kind = ?", (user_id, kind)
+                ).fetchone()[0]
+                self._insert_session(user_id, kind, position, session)
+            else:
+                self.connection.execute("DELETE FROM tasks WHERE session_id = ?", row)
+                self._insert_tasks(row[0], session)
+
+    def get_task_table(self, usernames=None, **kwargs):
+        """Builds the statistics table of the active users straight from the database.
+
+        Args:
+            usernames: list of str -- lower-cased user names, or None for all users
+        Returns:
+            TaskTable
+        """
+        from brag_stats import TaskTable, STATUS_CODES
+        users = self._get_users(usernames, active_only=True)
+        user_index = {row[0]: index for index, row in enumerate(users)}
+        ids = ", ".join(map(str, user_index))
+        goals_completed = [0] * len(users)
+        goal_rows = self.connection.execute(
+            "SELECT sessions.user_id, COUNT(*) FROM tasks JOIN sessions ON tasks.session_id = sessions.id "
+            "WHERE sessions.kind = 'goals' AND tasks.status = 'X' AND sessions.user_id IN ({}) "
+            "GROUP BY sessions.user_id".format(ids)
+        )
+        for user_id, count in goal_rows:
+            goals_completed[user_index[user_id]] = count
+
+        session_user, session_date, session_row = [], [], {}
+        session_rows = self.connection.execute(
+            "SELECT sessions.id, sessions.user_id, sessions.date FROM sessions JOIN users ON sessions.user_id = users.id "
+            "WHERE sessions.kind = 'session' AND sessions.user_id IN ({}) ORDER BY users.position, {}".format(ids, SESSION_ORDER)
+        )
+        for session_id, user_id, date in session_rows:
+            session_row[session_id] = len(session_user)
+            session_user.append(user_index[user_id])
+            session_date.append(datetime.fromisoformat(date) if date is not None else None)
+
+        task_session, task_status = [], []
+        task_rows = self.connection.execute(
+            "SELECT tasks.session_id, tasks.status FROM tasks JOIN sessions ON tasks.session_id = sessions.id "
+            "WHERE sessions.kind = 'session' AND sessions.user_id IN ({})".format(ids)
+        )
+        for session_id, status in task_rows:
+            task_session.append(session_row[session_id])
+            task_status.append(STATUS_CODES[status])
+        return TaskTable([row[1] for row in users], goals_completed, session_user, session_date, task_session, task_status, **kwargs)
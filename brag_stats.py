@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Statistics for BRAGs, computed from a columnar table of tasks.
+
+Uses NumPy if it is installed and plain Python otherwise.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, Manuel Ebert"
+__date__ = "2016-02-22"
+__email__ = "manuel@1450.me"
+
+INCOMPLETE = 0
+DONE = 1
+PARTIAL = 2
+STATUS_CODES = {' ': INCOMPLETE, 'X': DONE, 'O': PARTIAL}
+
+
+class TaskTable(object):
+    """All tasks of a group of users, stored column by column.
+
+    Sessions are numbered in order of user and date. For every session the table
+    holds the index of its user and its date; for every task the number of its
+    session and its status code (INCOMPLETE, DONE or PARTIAL).
+    """
+
+    def __init__(self, users, goals_completed, session_user, session_date, task_session, task_status, use_numpy=True):
+        """Initialises the table from its columns.
+
+        Args:
+            users: list of str -- user names
+            goals_completed: list of int -- number of completed goals per user
+            session_user: list of int -- index of the user of each session
+            session_date: list of datetime -- date of each session
+            task_session: list of int -- number of the session of each task
+            task_status: list of int -- status code of each task
+            use_numpy: bool -- If False, use plain Python even if NumPy is installed
+        """
+        self.numpy = numpy if use_numpy else None
+        self.users = users
+        self.session_date = session_date
+        if self.numpy is not None:
+            goals_completed = numpy.asarray(goals_completed, dtype=int)
+            session_user = numpy.asarray(session_user, dtype=int)
+            task_session = numpy.asarray(task_session, dtype=int)
+            task_status = numpy.asarray(task_status, dtype=int)
+        self.goals_completed = goals_completed
+        self.session_user = session_user
+        self.task_session = task_session
+        self.task_status = task_status
+
+    @classmethod
+    def from_users(cls, users, **kwargs):
+        """Builds the table in a single pass over the users' sessions.
+
+        Args:
+            users: iterable of User
+        Returns:
+            TaskTable
+        """
+        names, goals_completed, session_user, session_date, task_session, task_status = [], [], [], [], [], []
+        for index, user in enumerate(users):
+            names.append(user.qualified_name)
+            goals_completed.append(sum(1 for task in user.goals or () if task))
+            for session in user.sessions:
+                task_session.extend([len(session_user)] * len(session))
+                task_status.extend(STATUS_CODES[task.status.value] for task in session)
+                session_user.append(index)
+                session_date.append(session.date)
+        return cls(names, goals_completed, session_user, session_date, task_session, task_status, **kwargs)
+
+    def __len__(self):
+        """Returns the number of tasks in the table."""
+        return len(self.task_status)
+
+    def _count(self, indices, length, weights=None):
+        """Sums the weights (or counts the rows) for each index."""
+        if self.numpy is not None:
+            return self.numpy.bincount(indices, weights, minlength=length)
+        counts = [0] * length
+        if weights is None:
+            for index in indices:
+                counts[index] += 1
+        else:
+            for index, weight in zip(indices, weights):
+                counts[index] += weight
+        return counts
+
+    def _apply(self, function, *columns):
+        """Applies a function of numbers to whole columns."""
+        if self.numpy is not None:
+            return function(*columns)
+        return [function(*values) for values in zip(*columns)]
+
+    def _divide(self, numerators, denominators):
+        """Divides two columns, returning 0 wherever the denominator is 0."""
+        if self.numpy is not None:
+            numerators = numerators.astype(float)
+            return self.numpy.divide(numerators, denominators, out=self.numpy.zeros_like(numerators), where=denominators != 0)
+        return [n / d if d else 0 for n, d in zip(numerators, denominators)]
+
+    def _is_last(self):
+        """Returns a column that is true for the last (ongoing) session of every user."""
+        if self.numpy is not None:
+            return self.numpy.append(self.session_user[1:] != self.session_user[:-1], True)[:len(self.session_user)]
+        return [a != b for a, b in zip(self.session_user, self.session_user[1:])] + [True] * bool(self.session_user)
+
+    def session_tasks(self):
+        """Returns the number of tasks in each session."""
+        return self._count(self.task_session, len(self.session_user))
+
+    def session_completed(self):
+        """Returns the number of completed tasks in each session."""
+        done = self._apply(lambda status: status == DONE, self.task_status)
+        return self._count(self.task_session, len(self.session_user), done)
+
+    def session_ratios(self):
+        """Returns the share of completed tasks in each session."""
+        return self._divide(self.session_completed(), self.session_tasks())
+
+    def rolling_ratios(self, window=4):
+        """Returns the average completion ratio of each session and the sessions
+        of the same user before it, up to window sessions in total.
+
+        Raises:
+            ValueError -- if window is less than 1
+        """
+        if window < 1:
+            raise ValueError("The window must be at least 1 session, not {}".format(window))
+        ratios = self.session_ratios()
+        if self.numpy is not None:
+            rows = self.numpy.arange(len(ratios))
+            first = self.numpy.maximum.accumulate(self.numpy.where(self._first_rows(), rows, 0)) if len(ratios) else rows
+            lower = self.numpy.maximum(rows - window + 1, first)
+            sums = self.numpy.concatenate(([0.0], self.numpy.cumsum(ratios)))
+            return (sums[rows + 1] - sums[lower]) / (rows - lower + 1)
+        result, first = [], 0
+        for row, ratio in enumerate(ratios):
+            if row and self.session_user[row] != self.session_user[row - 1]:
+                first = row
+            lower = max(row - window + 1, first)
+            result.append(sum(ratios[lower:row + 1]) / (row - lower + 1))
+        return result
+
+    def _first_rows(self):
+        """Returns a column that is true for the first session of every user."""
+        return self.numpy.insert(self.session_user[1:] != self.session_user[:-1], 0, True)
+
+    def user_stats(self, window=4):
+        """Returns statistics on each user.
+
+        Besides the totals, 'Ratio (sessions)' is the average completion ratio of
+        a user's completed sessions and 'Ratio (last N)' the average over their
+        last N completed sessions. The last session of every user is ongoing and
+        doesn't count as completed.
+
+        Args:
+            window: int -- number of sessions for the rolling average
+        Returns:
+            list of dict -- in the order of TaskTable.users
+        Raises:
+            ValueError -- if window is less than 1
+        """
+        if window < 1:
+            raise ValueError("The window must be at least 1 session, not {}".format(window))
+        users = len(self.users)
+        tasks = self.session_tasks()
+        completed = self.session_completed()
+        last = self._is_last()
+        past = self._apply(lambda is_last: 1 - is_last, last)
+        ratios = self._divide(completed, tasks)
+        rolling = self.rolling_ratios(window)
+        # The rolling average of a user's last completed session is the one before their ongoing session
+        if self.numpy is not None:
+            previous_rolling = self.numpy.concatenate(([0.0], rolling[:-1]))
+        else:
+            previous_rolling = [0.0] + rolling[:-1]
+        totals = {
+            'Sessions': self._count(self.session_user, users),
+            'Total tasks': self._count(self.session_user, users, tasks),
+            'Tasks in progress': self._count(self.session_user, users, self._apply(lambda n, l: n * l, tasks, last)),
+            'Tasks completed': self._count(self.session_user, users, completed),
+            'Tasks missed': self._count(self.session_user, users, self._apply(lambda n, c, p: (n - c) * p, tasks, completed, past)),
+            'Goals completed': self.goals_completed,
+        }
+        past_sessions = self._count(self.session_user, users, past)
+        session_ratios = self._divide(self._count(self.session_user, users, self._apply(lambda r, p: r * p, ratios, past)), past_sessions)
+        last_rolling = self._count(self.session_user, users, self._apply(lambda r, l: r * l, previous_rolling, last))
+        result = []
+        for user in range(users):
+            stats = {key: int(column[user]) for key, column in totals.items()}
+            finished = stats['Tasks completed'] + stats['Tasks missed']
+            stats['Ratio'] = 0 if finished == 0 else stats['Tasks completed'] / finished
+            stats['Ratio (sessions)'] = float(session_ratios[user])
+            stats['Ratio (last {})'.format(window)] = float(last_rolling[user]) if past_sessions[user] else 0.0
+            result.append(stats)
+        return result
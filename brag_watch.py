@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Keeps a Brag in sync with its file.
+
+Uses inotify on Linux and polls the file elsewhere. When the file changes,
+only the user sections whose bytes changed are parsed again.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from brag import Brag, get_archived_dates, scan_user_sections
+from collections import namedtuple
+import ctypes
+import ctypes.util
+import hashlib
+import io
+import os
+import select
+import struct
+import threading
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, Manuel Ebert"
+__date__ = "2016-02-22"
+__email__ = "manuel@1450.me"
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+# Seconds without events before a changed file is read
+SETTLE = 0.05
+# Editors and Brag.write replace the file rather than writing to it, so the
+# directory is watched for anything that ends up under the file's name.
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+Change = namedtuple('Change', ['added', 'changed', 'removed'])
+Section = namedtuple('Section', ['digest', 'start', 'end', 'user'])
+
+
+def get_inotify():
+    """Returns the libc functions for inotify, or None if they aren't available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+class Watcher(object):
+    """Watches the file of a brag and swaps re-parsed users into it when it changes.
+
+    Users whose sections are unchanged are kept as they are, including the byte
+    ranges Brag.write uses to copy unchanged sessions. Call check to sync by
+    hand, or start to sync in a background thread. Hold Watcher.lock while
+    reading the brag from another thread to never see it mid-update.
+    """
+
+    def __init__(self, brag, on_change=None, interval=1.0):
+        """Initialises the watcher.
+
+        Args:
+            brag: Brag -- read from a file
+            on_change: callable -- called with the brag and a Change of the
+                added, changed and removed users after every update
+            interval: float -- seconds between checks when polling
+        """
+        self.brag = brag
+        self.on_change = on_change
+        self.interval = interval
+        self.lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+        self._key = brag._source_key
+        self._sections = None
+        try:
+            with open(brag.filename, 'rb') as f:
+                data = f.read()
+            if self._key == Brag._get_cache_key(brag.filename):
+                sections = list(self._scan(data))
+                if len(sections) == len(brag.users):
+                    self._sections = [section._replace(user=user) for section, user in zip(sections, brag.users)]
+        except OSError:
+            pass
+        if self._sections is None:
+            # The brag doesn't match the file; the first check parses every user
+            self._key, self._sections = None, []
+
+    @property
+    def key(self):
+        """The key (see Brag._get_cache_key) of the file as the brag last
+        reflected it, or None before the first check."""
+        return self._key
+
+    @staticmethod
+    def _scan(data):
+        """Yields a Section without a user for every user section in the file's data."""
+        for header, start, end in scan_user_sections(io.BytesIO(data)):
+            yield Section(hashlib.sha1(data[start:end]).digest(), start, end, None)
+
+    def check(self):
+        """Updates the brag if its file changed since the last check.
+
+        Returns:
+            Change -- or None if nothing changed
+        """
+        with self.lock:
+            try:
+                key = Brag._get_cache_key(self.brag.filename)
+                if key == self._key:
+                    return None
+                with open(self.brag.filename, 'rb') as f:
+                    data = f.read()
+                if Brag._get_cache_key(self.brag.filename) != key:
+                    # Still being written, try again next time
+                    return None
+            except OSError:
+                return None
+            if key == self.brag._source_key:
+                # Written by the brag itself, eg. with Brag.write
+                sections = list(self._scan(data))
+                if len(sections) == len(self.brag.users):
+                    self._key = key
+                    self._sections = [section._replace(user=user) for section, user in zip(sections, self.brag.users)]
+                    return None
+            old_sections = {}
+            for section in self._sections:
+                old_sections.setdefault(section.digest, []).append(section)
+            sections, added = [], []
+            for section in self._scan(data):
+                candidates = old_sections.get(section.digest)
+                if candidates:
+                    old = candidates.pop(0)
+                    user = self._move(old.user, section.start - old.start, section)
+                else:
+                    text = io.TextIOWrapper(io.BytesIO(data[section.start:section.end]), encoding='utf-8')
+                    user = Brag.from_lines(text).users[0]
+                    added.append(user)
+                sections.append(section._replace(user=user))
+            removed = [old.user for candidates in old_sections.values() for old in candidates]
+            # The file may have been compacted
+            self.brag.unloaded_dates = get_archived_dates(self.brag.filename)
+            self.brag.users = [section.user for section in sections]
+            self.brag._source_key = self._key = key
+            self._sections = sections
+            added_names = set(user.name for user in added)
+            removed_names = set(user.name for user in removed)
+            change = Change(
+                added=[user for user in added if user.name not in removed_names],
+                changed=[user for user in added if user.name in removed_names],
+                removed=[user for user in removed if user.name not in added_names],
+            )
+        if self.on_change is not None and any(change):
+            self.on_change(self.brag, change)
+        return change
+
+    def _move(self, user, shift, section):
+        """Points an unchanged user's byte ranges at their section's new location."""
+        if user.__dict__.get("_source") is not None:
+            user._source = self.brag.filename, section.start, section.end
+            return user
+        if shift:
+            for session in [user.goals] + list(user.sessions):
+                if session is not None and session._span is not None:
+                    session._span = session._span[0] + shift, session._span[1] + shift
+        return user
+
+    def watch(self):
+        """Checks the file whenever it changes, until stop is called."""
+        inotify = get_inotify()
+        fd = -1
+        if inotify is not None:
+            inotify_init1, inotify_add_watch = inotify
+            fd = inotify_init1(IN_CLOEXEC)
+            directory = os.path.dirname(os.path.abspath(self.brag.filename))
+            if fd >= 0 and inotify_add_watch(fd, directory.encode('utf-8'), WATCH_MASK) < 0:
+                os.close(fd)
+                fd = -1
+        try:
+            # Catch up on anything that changed before the file was watched
+            try:
+                self.check()
+            finally:
+                self._ready.set()
+            if fd < 0:
+                while not self._stopped.wait(self.interval):
+                    self.check()
+            else:
+                self._watch_inotify(fd)
+        finally:
+            if fd >= 0:
+                os.close(fd)
+
+    def _watch_inotify(self, fd):
+        """Waits for inotify events on the file's name and checks the file once
+        a burst of events has settled, so a file that's being written in several
+        steps isn't parsed halfway."""
+        name = os.path.basename(self.brag.filename).encode('utf-8')
+        pending = False
+        while not self._stopped.is_set():
+            # Wake up regularly to notice stop, and to catch anything inotify missed
+            ready, _, _ = select.select([fd], [], [], SETTLE if pending else self.interval)
+            if not ready:
+                self.check()
+                pending = False
+                continue
+            data = os.read(fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                pending = pending or data[offset:offset + length].rstrip(b"\0") == name
+                offset += length
+
+    def start(self):
+        """Watches the file in a background thread. Returns once the file is
+        being watched."""
+        self._stopped.clear()
+        self._ready.clear()
+        self._thread = threading.Thread(target=self.watch, name="brag-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        """Stops the background thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None